@@ -0,0 +1,128 @@
+import ast
+
+import numpy as np
+
+from bands import compute_dtype
+
+BLOCK_BYTES = 8 * 2 ** 20  # size of a block of rows of the result evaluated at once
+
+FUNCTIONS = {'abs': (np.abs, 1), 'sqrt': (np.sqrt, 1), 'log': (np.log, 1), 'exp': (np.exp, 1),
+             'minimum': (np.minimum, 2), 'maximum': (np.maximum, 2)}  # name -> function, number of arguments
+OPERATORS = {ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply, ast.Div: np.divide, ast.Pow: np.power}
+
+
+class FormulaError(ValueError):
+    pass
+
+
+class Formula:
+    """ Band math expression (e.g. `(red - nir) / (red + nir + blue)`) parsed once into a validated tree.
+        Evaluation goes by blocks of rows reusing temporaries in place, division by zero gives `fill`. """
+
+    def __init__(self, text, band_names, fill=0.):
+        self.text = text
+        self.fill = fill
+        self.bands = set()
+        try:
+            self._tree = self._compile(ast.parse(text, mode='eval').body, band_names)
+        except SyntaxError as e:
+            raise FormulaError(f'Cannot parse formula "{text}": {e.msg}')
+        if not self.bands:
+            raise FormulaError(f'Formula "{text}" does not use any band')
+
+    def _compile(self, node, band_names):
+        if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            return 'const', float(node.value)
+        if isinstance(node, ast.Name) and node.id in band_names:
+            self.bands.add(node.id)
+            return 'band', node.id
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.UAdd, ast.USub)):
+            operand = self._compile(node.operand, band_names)
+            return operand if isinstance(node.op, ast.UAdd) else self._call(np.negative, [operand])
+        if isinstance(node, ast.BinOp) and type(node.op) in OPERATORS:
+            return self._call(OPERATORS[type(node.op)], [self._compile(node.left, band_names),
+                                                         self._compile(node.right, band_names)])
+        if isinstance(node, ast.Call) and not node.keywords and self._function_name(node.func) in FUNCTIONS:
+            name = self._function_name(node.func)
+            f, n_args = FUNCTIONS[name]
+            if len(node.args) != n_args:
+                raise FormulaError(f'Function {name} in formula "{self.text}" takes {n_args} argument(s), '
+                                   f'{len(node.args)} given')
+            return self._call(f, [self._compile(a, band_names) for a in node.args])
+        raise FormulaError(f'Not allowed in formula "{self.text}": {ast.unparse(node)}')
+
+    def _call(self, f, args):
+        if all(a[0] == 'const' for a in args):  # constant subexpressions are folded
+            with np.errstate(divide='ignore', invalid='ignore'):
+                value = float(f(*(a[1] for a in args)))
+            return 'const', self.fill if f is np.divide and args[1][1] == 0 else value
+        return 'call', f, args
+
+    @staticmethod
+    def _function_name(func):
+        """`sqrt` or `np.sqrt` to 'sqrt'."""
+        if isinstance(func, ast.Name):
+            return func.id
+        if isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) and func.value.id == 'np':
+            return func.attr
+        return None
+
+    def shape(self, bands):
+        """Shape of the result over bands (name -> array or lazy band)."""
+        if self.bands - bands.keys():
+            raise FormulaError(f'Bands {sorted(self.bands - bands.keys())} of formula "{self.text}" are not loaded')
+        shapes = {bands[b].shape for b in self.bands}
+        if len(shapes) > 1:
+            raise FormulaError(f'Bands of formula "{self.text}" have different shapes {shapes}')
+        return shapes.pop()
+
+    def evaluate(self, bands, out=None):
+        """Evaluate formula over bands (name -> array or lazy band, all of the same shape)."""
+        shape = self.shape(bands)
+        if out is None:
+            out = np.empty(shape, dtype=compute_dtype())
+
+        block = max(1, BLOCK_BYTES // (shape[1] * out.itemsize))
+        for r0 in range(0, shape[0], block):
+            out[r0:r0 + block] = self.window(bands, slice(r0, r0 + block))
+        return out
+
+    def window(self, bands, key):
+        """Result on the window bands[key] only."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self._evaluate(self._tree, bands, key)[0]
+
+    def _evaluate(self, node, bands, rows):
+        """Value of node on rows and whether it is a temporary which may be overwritten."""
+        if node[0] == 'const':
+            return node[1], False
+        if node[0] == 'band':
+            return np.asarray(bands[node[1]][rows], dtype=compute_dtype()), False
+
+        _, f, args = node
+        values = [self._evaluate(a, bands, rows) for a in args]
+        out = next((v for v, temporary in values if temporary), None)  # reuse a temporary for the result
+        zero = values[1][0] == 0 if f is np.divide else None  # before the divisor may be overwritten
+        res = f(*(v for v, _ in values), out=out)
+        if zero is not None:
+            np.copyto(res, self.fill, where=np.broadcast_to(zero, res.shape))
+        return res, True
+
+
+class FormulaBand:
+    """ Result of a formula computed only for the windows it is sliced with, like a lazy band """
+
+    ndim = 2
+
+    def __init__(self, formula, bands):
+        self.formula = formula
+        self.bands = bands
+        self.shape = formula.shape(bands)
+        self.dtype = compute_dtype()
+
+    def __getitem__(self, key):
+        return self.formula.window(self.bands, key)
+
+    def __array__(self, dtype=None, copy=None):
+        a = self.formula.evaluate(self.bands)
+        return a if dtype is None else a.astype(dtype, copy=False)
@@ -0,0 +1,148 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+PRECISIONS = {'float32': np.float32, 'float64': np.float64}
+
+_compute_dtype = np.dtype(PRECISIONS[os.environ.get('SOIL_REGION_PRECISION', 'float32')])
+
+DEFAULT_CACHE_BYTES = int(os.environ.get('SOIL_REGION_CACHE_MB', 1024)) * 2 ** 20
+
+
+def set_compute_precision(precision):
+    """Set dtype ('float32' or 'float64') to which native bands are promoted for computations."""
+    global _compute_dtype
+    if precision not in PRECISIONS:
+        raise ValueError(f'Unknown precision {precision}, expected one of {list(PRECISIONS)}')
+    _compute_dtype = np.dtype(PRECISIONS[precision])
+
+
+def compute_dtype():
+    return _compute_dtype
+
+
+def read_only(a):
+    view = a.view()
+    view.flags.writeable = False
+    return view
+
+
+class BandCache:
+    """ LRU cache of arrays with a limit on their total size, arrays are handed out as read-only views """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self._arrays = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self._arrays
+
+    def keys(self):
+        return list(self._arrays.keys())
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._arrays:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._arrays.move_to_end(key)
+            return self._arrays[key]
+
+    def put(self, key, array):
+        array = read_only(array)
+        with self._lock:
+            self._pop(key)
+            self._arrays[key] = array
+            self.bytes += array.nbytes
+            while self.bytes > self.max_bytes and len(self._arrays) > 1:  # the newest array is always kept
+                self._pop(next(iter(self._arrays)))
+        return array
+
+    def pop(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def _pop(self, key):
+        if key in self._arrays:
+            self.bytes -= self._arrays.pop(key).nbytes
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'bytes': self.bytes, 'entries': len(self._arrays)}
+
+
+class LazyBand:
+    """ Single-band raster which reads GDAL block windows only when it is sliced """
+
+    ndim = 2
+    chunk_bytes = 64 * 2 ** 20  # upper bound for a single window read of a strided slice
+
+    def __init__(self, path, ds=None):
+        from osgeo import gdal, gdal_array
+
+        self.path = path
+        self._ds = ds if ds is not None else gdal.Open(path)
+        self._band = self._ds.GetRasterBand(1)
+        self._lock = threading.Lock()  # GDAL datasets must not be read from several threads at once
+        self.shape = (self._ds.RasterYSize, self._ds.RasterXSize)
+        self.dtype = np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(self._band.DataType))
+        block_cols, block_rows = self._band.GetBlockSize()
+        self.block_shape = (block_rows, block_cols)
+
+    @property
+    def size(self):
+        return self.shape[0] * self.shape[1]
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def read(self, row, col, n_rows, n_cols):
+        """Read window of n_rows x n_cols pixels starting at (row, col)."""
+        with self._lock:
+            return self._band.ReadAsArray(col, row, n_cols, n_rows)
+
+    def __getitem__(self, key):
+        rows, cols = self._ranges(key)
+        if len(rows) == 0 or len(cols) == 0:
+            return np.empty((len(rows), len(cols)), dtype=self.dtype)
+        col, n_cols = cols.start, cols[-1] - cols.start + 1
+
+        if rows.step == 1:
+            return self.read(rows.start, col, len(rows), n_cols)[:, ::cols.step]
+
+        out = np.empty((len(rows), len(cols)), dtype=self.dtype)
+        if rows.step > self.block_shape[0]:  # every requested row lies in its own block
+            for i, row in enumerate(rows):
+                out[i] = self.read(row, col, 1, n_cols)[0, ::cols.step]
+            return out
+
+        chunk = max(1, self.chunk_bytes // (rows.step * n_cols * self.dtype.itemsize))
+        for i in range(0, len(rows), chunk):
+            j = min(i + chunk, len(rows))
+            window = self.read(rows[i], col, rows[j - 1] - rows[i] + 1, n_cols)
+            out[i:j] = window[::rows.step, ::cols.step]
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        a = self[:, :]
+        return a if dtype is None else a.astype(dtype, copy=False)
+
+    def _ranges(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) == 1 and key[0] is Ellipsis:
+            key = ()
+        key = key + (slice(None),) * (2 - len(key))
+        if len(key) != 2 or not all(isinstance(k, slice) for k in key):
+            raise TypeError(f'LazyBand supports only slices, got {key}')
+        ranges = tuple(range(*k.indices(n)) for k, n in zip(key, self.shape))
+        if any(r.step < 0 for r in ranges):
+            raise ValueError('LazyBand does not support negative steps')
+        return ranges
@@ -0,0 +1,76 @@
+"""Classify scenes with a region saved by the histogram window, without the GUI.
+Example: python batch_classify.py region.json "scenes/*_LC08_*_red_04.tif" --jobs 4 --output-dir masks"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from export import write_classified
+from map_app import MapImage
+from utils import region_mask
+
+
+def find_scenes(patterns):
+    """Channel file of each distinct scene matched by paths or glob patterns, in the given order."""
+    scenes = dict()
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]:
+            if MapImage.validate_img_path(path):
+                scenes.setdefault(MapImage(None)._get_img_name(path), path)
+    return list(scenes.values())
+
+
+def classify_scene(img_path, region, output_dir):
+    """Write the classified mask of a scene, returns its path, number of pixels and time spent."""
+    start = time.perf_counter()
+    map_image = MapImage(None)
+    map_image.load(img_path)
+    mask = region_mask(region)
+    band = map_image.reference_band()
+    meta = map_image.meta_dict[band]
+    shape = map_image.bands[band].shape
+    fn = os.path.join(output_dir, f'{map_image.img_name}_mask.tif')
+    write_classified(fn, [map_image.source_band(c) for c in mask.channels], mask, shape,
+                     meta['geotransform'], meta['projection'])
+    return fn, shape[0] * shape[1], time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('region', help='region .json saved by the histogram window')
+    parser.add_argument('scenes', nargs='+', help='a channel .tif of each scene, glob patterns are expanded')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='number of worker processes')
+    parser.add_argument('--output-dir', default='.', help='directory of <scene>_mask.tif files')
+    args = parser.parse_args(argv)
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+
+    region = json.load(open(args.region))
+    scenes = find_scenes(args.scenes)
+    if not scenes:
+        parser.error('no scene files matched')
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    start, pixels, failed = time.perf_counter(), 0, 0
+    with ProcessPoolExecutor(max_workers=min(args.jobs, len(scenes))) as pool:
+        futures = {pool.submit(classify_scene, s, region, args.output_dir): s for s in scenes}
+        for future in as_completed(futures):
+            try:
+                fn, n, seconds = future.result()
+            except Exception as e:
+                failed += 1
+                print(f'{futures[future]}: failed: {type(e).__name__}: {e}', file=sys.stderr)
+                continue
+            pixels += n
+            print(f'{fn}: {n / 1e6:.1f} Mpx in {seconds:.1f} s ({n / 1e6 / seconds:.1f} Mpx/s)')
+    seconds = time.perf_counter() - start
+    print(f'{len(scenes) - failed} of {len(scenes)} scenes, {pixels / 1e6:.1f} Mpx in {seconds:.1f} s '
+          f'({pixels / 1e6 / seconds:.1f} Mpx/s)')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
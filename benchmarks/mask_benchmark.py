@@ -0,0 +1,48 @@
+"""Throughput of utils.Mask.get_value compared with the implementation it replaced.
+Run from the repository root: python -m benchmarks.mask_benchmark [size] [steps]"""
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from utils import Mask
+
+
+def reference(mask, x, y):
+    """Mask.get_value before it was chunked, flattens the mask and returns int64 labels."""
+    x_ = np.maximum(np.minimum(((x - mask.x_min) // mask.x_step).astype(int), mask.array.shape[0] - 1), 0)
+    y_ = np.maximum(np.minimum(((y - mask.y_min) // mask.y_step).astype(int), mask.array.shape[1] - 1), 0)
+    return mask.array.flatten()[x_ * mask.array.shape[1] + y_]
+
+
+def measure(f, *args):
+    tracemalloc.start()
+    t = time.perf_counter()
+    res = f(*args)
+    t = time.perf_counter() - t
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return res, t, peak
+
+
+def main(n=4000, steps=300):
+    rng = np.random.default_rng(0)
+    x = rng.normal(8000, 2000, (n, n)).astype(np.float32)
+    y = rng.normal(9000, 2500, (n, n)).astype(np.float32)
+    hist = np.histogram2d(x[::10, ::10].ravel(), y[::10, ::10].ravel(), bins=[steps, steps])
+    array = rng.integers(0, 5, (steps, steps))
+    mask = Mask(hist[1][0], hist[1][-1], hist[1][1] - hist[1][0], hist[2][0], hist[2][-1], hist[2][1] - hist[2][0],
+                array, ['04', '05'])
+    out = np.empty(x.shape, dtype=np.uint8)
+
+    ref, t_ref, m_ref = measure(reference, mask, x, y)
+    res, t_res, m_res = measure(mask.get_value, x, y, out)
+    print(f'{n}x{n} pixels, {steps}x{steps} mask, labels equal: {np.array_equal(ref, res)}')
+    print(f'{"":>10} {"Mpx/s":>8} {"s":>6} {"peak MB":>8}')
+    for name, t, m in [('before', t_ref, m_ref), ('get_value', t_res, m_res)]:
+        print(f'{name:>10} {x.size / t / 1e6:8.1f} {t:6.2f} {m / 2 ** 20:8.0f}')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
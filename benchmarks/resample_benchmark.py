@@ -0,0 +1,52 @@
+"""Compare resample.resample with the cubic spline interpolation used before (scipy interp2d).
+Run from the repository root: python -m benchmarks.resample_benchmark [size] [noise]"""
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from scipy.interpolate import RectBivariateSpline
+
+from resample import resample, choose_mode
+
+
+def scene(n, noise, seed=0):
+    """Smooth reflectance-like uint16 field with gaussian noise."""
+    rng = np.random.default_rng(seed)
+    u = np.linspace(0, 8 * np.pi, n)
+    a = 8000 + 3000 * np.sin(u)[:, None] * np.cos(0.7 * u)[None, :] + rng.normal(0, noise, (n, n))
+    return np.clip(a, 0, 65535).astype(np.uint16)
+
+
+def spline(a, shape):
+    """Output of interp2d(kind='cubic') on a regular grid, which is removed from recent scipy."""
+    f = RectBivariateSpline(np.linspace(0, 1, a.shape[0]), np.linspace(0, 1, a.shape[1]), a, kx=3, ky=3, s=0)
+    return f(np.linspace(0, 1, shape[0]), np.linspace(0, 1, shape[1]))
+
+
+def measure(f, *args):
+    tracemalloc.start()
+    t = time.perf_counter()
+    res = f(*args)
+    t = time.perf_counter() - t
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return res, t, peak
+
+
+def main(n=2000, noise=300):
+    a = scene(n, noise)
+    print(f'source {a.shape} {a.dtype}')
+    print(f'{"target":>12} {"mode":>10} {"spline s":>9} {"new s":>7} {"spline MB":>10} {"new MB":>7} '
+          f'{"max diff":>9} {"mean diff":>9}')
+    for factor in [0.3, 0.7, 1.5, 2.0]:
+        shape = (int(n * factor), int(n * factor * 1.1))
+        ref, t_ref, m_ref = measure(spline, a.astype(float), shape)
+        res, t_res, m_res = measure(resample, a, shape)
+        diff = np.abs(res - ref)
+        print(f'{str(shape):>12} {choose_mode(n, shape[0]):>10} {t_ref:9.2f} {t_res:7.2f} '
+              f'{m_ref / 2 ** 20:10.0f} {m_res / 2 ** 20:7.0f} {diff.max():9.1f} {diff.mean():9.2f}')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
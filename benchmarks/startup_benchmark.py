@@ -0,0 +1,55 @@
+"""Cold start of the app: time to import its modules and time from process start to the first window,
+each measured in fresh interpreters. Run from the repository root: python -m benchmarks.startup_benchmark [runs]"""
+import statistics
+import subprocess
+import sys
+import time
+
+MODULES = ['utils', 'map_app', 'batch_classify']
+
+IMPORT = '''
+import time
+t = time.perf_counter()
+import {module}
+print(time.perf_counter() - t)
+'''
+
+FIRST_WINDOW = '''
+import time
+import tkinter as tk
+from map_app import MapWindow
+app = tk.Tk()
+MapWindow(app)
+app.update()
+print(time.time())
+app.destroy()
+'''
+
+
+def run(code):
+    """Output of code in a fresh interpreter as a float, None if it fails (e.g. no display for a window)."""
+    res = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+    if res.returncode != 0:
+        return None
+    return float(res.stdout.split()[-1])
+
+
+def first_window():
+    start = time.time()
+    shown = run(FIRST_WINDOW)
+    return None if shown is None else shown - start
+
+
+def main(runs=5):
+    print(f'{"":>22} {"median s":>9} {"min s":>7}')
+    rows = [(f'import {m}', [run(IMPORT.format(module=m)) for _ in range(runs)]) for m in MODULES]
+    rows.append(('first window', [first_window() for _ in range(runs)]))
+    for name, times in rows:
+        if None in times:
+            print(f'{name:>22} failed (missing dependency or display)')
+        else:
+            print(f'{name:>22} {statistics.median(times):9.3f} {min(times):7.3f}')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,65 @@
+import numpy as np
+from PIL import Image
+
+
+class LutImage:
+    """ RGB image made of three unsigned integer bands, each mapped to uint8 by its own lookup table.
+        Implements the part of PIL.Image used by CanvasImage, pixels are rendered only for cropped areas.
+        Copies and reductions share the tables, so `set_luts` restretches all of them in place. """
+
+    mode = 'RGB'
+
+    def __init__(self, bands, luts):
+        self.bands = bands  # three arrays of shape (height, width)
+        self.luts = luts  # list shared with copies and reductions
+
+    @property
+    def size(self):
+        return self.bands[0].shape[1], self.bands[0].shape[0]
+
+    @property
+    def width(self):
+        return self.size[0]
+
+    @property
+    def height(self):
+        return self.size[1]
+
+    def set_luts(self, luts):
+        self.luts[:] = luts
+
+    def copy(self):
+        return LutImage(self.bands, self.luts)
+
+    def render(self, rows=slice(None), cols=slice(None)):
+        """uint8 array (rows, cols, 3) of the area."""
+        out = np.empty(self.bands[0][rows, cols].shape + (3,), dtype=np.uint8)
+        for i, (band, lut) in enumerate(zip(self.bands, self.luts)):
+            np.take(lut, band[rows, cols], out=out[..., i])
+        return out
+
+    def crop(self, box):
+        x0, y0, x1, y1 = (int(round(v)) for v in box)
+        return Image.fromarray(self.render(slice(max(y0, 0), max(y1, 0)), slice(max(x0, 0), max(x1, 0))), mode='RGB')
+
+    def resize(self, size, resample=None, box=None):
+        """Nearest neighbour sampling of box (x0, y0, x1, y1) of the image to size, whatever resample is."""
+        x0, y0, x1, y1 = box if box is not None else (0, 0, self.width, self.height)
+        cols = np.minimum((np.arange(size[0]) + .5) * ((x1 - x0) / size[0]) + x0, self.width - 1).astype(np.intp)
+        rows = np.minimum((np.arange(size[1]) + .5) * ((y1 - y0) / size[1]) + y0, self.height - 1).astype(np.intp)
+        return Image.fromarray(self.render(rows[:, None], cols[None, :]), mode='RGB')
+
+    def reduce(self, factor):
+        """Image `factor` times smaller, bands are averaged over blocks of factor x factor pixels."""
+        return LutImage([self._reduce_band(b, factor) for b in self.bands], self.luts)
+
+    @staticmethod
+    def _reduce_band(band, factor):
+        rows, cols = np.arange(0, band.shape[0], factor), np.arange(0, band.shape[1], factor)
+        total = np.add.reduceat(np.add.reduceat(band, rows, axis=0, dtype=np.uint32), cols, axis=1)
+        count = np.outer(np.diff(np.append(rows, band.shape[0])), np.diff(np.append(cols, band.shape[1])))
+        return ((total + count // 2) // count).astype(band.dtype)
+
+    def __array__(self, dtype=None, copy=None):
+        a = self.render()
+        return a if dtype is None else a.astype(dtype, copy=False)
@@ -0,0 +1,34 @@
+import numpy as np
+
+from bands import compute_dtype
+from resample import fit_rows
+
+CREATION_OPTIONS = ['TILED=YES', 'COMPRESS=DEFLATE', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256', 'BIGTIFF=IF_SAFER']
+OVERVIEWS = (2, 4, 8, 16, 32)
+
+
+def write_classified(fn, sources, mask, shape, geotransform, projection, overviews=OVERVIEWS, progress=None):
+    """Write classes of mask as a tiled, compressed Byte GeoTIFF of shape, one row of blocks at a time.
+    sources are the mask channels (arrays or lazy bands), brought to shape like MapImage.get_bands does.
+    progress is called with (rows written, total rows)."""
+    from osgeo import gdal
+
+    driver = gdal.GetDriverByName('GTiff')
+    ds = driver.Create(fn, shape[1], shape[0], 1, gdal.GDT_Byte, CREATION_OPTIONS)
+    ds.SetGeoTransform(geotransform)
+    ds.SetProjection(projection)
+    band = ds.GetRasterBand(1)
+
+    block_rows = band.GetBlockSize()[1]
+    labels = np.empty((block_rows, shape[1]), dtype=np.uint8)
+    for r0 in range(0, shape[0], block_rows):
+        r1 = min(r0 + block_rows, shape[0])
+        values = [np.asarray(fit_rows(a, shape, r0, r1), dtype=compute_dtype()) for a in sources]
+        band.WriteArray(mask.get_value(*values, out=labels[:r1 - r0]), 0, r0)
+        if progress is not None:
+            progress(r1, shape[0])
+
+    levels = [f for f in overviews if min(shape) // f > 0]
+    if levels:
+        ds.BuildOverviews('NEAREST', levels)
+    ds.FlushCache()  # saves to disk
@@ -0,0 +1,152 @@
+import math
+
+import numpy as np
+
+CHUNK_PIXELS = 2 ** 22  # pixels counted at once, bincount converts them to intp
+
+
+class ValueHistogram:
+    """ Count of every value of an unsigned integer band.
+        Quantiles and means equal to those of numpy computed on the band itself, at O(number of values) cost. """
+
+    def __init__(self, counts, dtype=np.float32):
+        self.counts = counts
+        self.dtype = np.dtype(dtype)  # dtype in which numpy would compute quantiles of the band
+        self._cdf = np.cumsum(counts)
+
+    @classmethod
+    def of(cls, a, dtype=np.float32):
+        flat = np.asarray(a).ravel()
+        counts = np.zeros(np.iinfo(flat.dtype).max + 1, dtype=np.int64)
+        for i in range(0, flat.size, CHUNK_PIXELS):
+            counts += np.bincount(flat[i:i + CHUNK_PIXELS], minlength=counts.size)
+        return cls(counts, dtype)
+
+    @property
+    def n(self):
+        return int(self._cdf[-1])
+
+    def min(self):
+        return self.dtype.type(np.argmax(self._cdf > 0))
+
+    def max(self):
+        return self.dtype.type(np.searchsorted(self._cdf, self._cdf[-1]))
+
+    def mean(self):
+        return float(np.dot(self.counts, np.arange(self.counts.size, dtype=np.float64)) / self.n)
+
+    def between(self, low, high):
+        """Histogram of values strictly between low and high."""
+        counts = self.counts.copy()
+        counts[:max(0, math.floor(low) + 1)] = 0
+        counts[max(0, math.ceil(high)):] = 0
+        return ValueHistogram(counts, self.dtype)
+
+    def _value(self, k):
+        """k-th smallest value."""
+        return self.dtype.type(np.searchsorted(self._cdf, k, side='right'))
+
+    def bins(self, low, high, bins):
+        """Counts of values in `bins` equal bins over [low, high], same as np.histogram of the band."""
+        counts, _ = np.histogram(np.arange(self.counts.size), bins, (low, high), weights=self.counts)
+        return counts.astype(np.int64)
+
+    def quantile(self, q):
+        """Same as np.quantile(band, q) with the default 'linear' method."""
+        virtual = (self.n - 1) * q
+        previous = math.floor(virtual)
+        a, b = self._value(previous), self._value(min(previous + 1, self.n - 1))
+        t = virtual - previous
+        diff = b - a
+        return b - diff * (1 - t) if t >= .5 else a + diff * t
+
+
+def bin_counts(a, low, high, bins):
+    """Counts of values of a in `bins` equal bins over [low, high] like np.histogram, in one pass by chunks.
+    Values out of the range and NaN are not counted."""
+    flat = np.asarray(a).ravel()
+    step = (high - low) / bins if high > low else 1
+    counts = np.zeros(bins, dtype=np.int64)
+    out = np.empty(min(CHUNK_PIXELS, flat.size), dtype=np.intp)
+    for i in range(0, flat.size, CHUNK_PIXELS):
+        chunk = flat[i:i + CHUNK_PIXELS]
+        index = bin_index(chunk, low, step, bins, out[:chunk.size])
+        counts += np.bincount(index[(chunk >= low) & (chunk <= high)], minlength=bins)
+    return counts
+
+
+def bin_dtype(values, v_min, step):
+    """dtype in which numpy computes `(values - v_min) // step`."""
+    return ((values.ravel()[:0] - v_min) // step).dtype
+
+
+def bin_index(values, v_min, step, n, out, buf=None):
+    """Index of the bin of width step starting at v_min of each value, clipped to [0, n), written into out (intp).
+    Same as `(values - v_min) // step` cast to int and clipped, buf of bin_dtype may hold the intermediate."""
+    if buf is None:
+        buf = np.empty(values.shape, dtype=bin_dtype(values, v_min, step))
+    np.subtract(values, v_min, out=buf)
+    np.divide(buf, step, out=buf)  # much faster than floor_divide of floats
+    with np.errstate(invalid='ignore'):  # truncation equals floor for quotients which are not clipped to 0
+        out[...] = buf
+    exact = np.nonzero(buf == out)  # quotient rounded to an integer may be just below it, `//` decides
+    if len(exact[0]):
+        out[exact] = (values[exact] - v_min) // step
+    return np.clip(out, 0, n - 1, out=out)
+
+
+class BinIndex:
+    """ Flat index of the 2-D histogram bin of every pixel of two channels, computed once for given ranges and steps.
+        Bins are those a Mask with the same edges classifies pixels by. Values out of the ranges (and NaN) fall in
+        a margin of bins around the grid, so the histogram of any subset of pixels is a single bincount. """
+
+    def __init__(self, index, x_range, y_range, steps):
+        self.steps = tuple(int(s) for s in steps)
+        self.edges = [np.linspace(float(low), float(high), n + 1)
+                      for (low, high), n in zip((x_range, y_range), self.steps)]
+        self.size = (self.steps[0] + 2) * (self.steps[1] + 2)
+        self.shape = index.shape
+        self.index = index.ravel()
+
+    @classmethod
+    def of(cls, x, y, x_range, y_range, steps):
+        """Bin index of channels x and y, computed by chunks."""
+        res = cls(np.empty(0, dtype=np.uint16), x_range, y_range, steps)
+        index = np.empty(np.shape(x), dtype=np.uint16 if res.size <= 2 ** 16 else np.uint32)
+        x, y, flat = np.asarray(x).ravel(), np.asarray(y).ravel(), index.ravel()
+        xi = np.empty(min(CHUNK_PIXELS, x.size), dtype=np.intp)
+        yi = np.empty_like(xi)
+        for i in range(0, x.size, CHUNK_PIXELS):
+            n = min(CHUNK_PIXELS, x.size - i)
+            cls._axis_index(x[i:i + n], res.edges[0], xi[:n])
+            cls._axis_index(y[i:i + n], res.edges[1], yi[:n])
+            xi[:n] *= res.steps[1] + 2
+            xi[:n] += yi[:n]
+            flat[i:i + n] = xi[:n]
+        return cls(index, x_range, y_range, steps)
+
+    @staticmethod
+    def _axis_index(values, edges, out):
+        """Bin of each value shifted by one, 0 below the range or NaN, len(edges) above it."""
+        bin_index(values, edges[0], edges[1] - edges[0], len(edges) - 1, out)
+        out += 1
+        out[~(values >= edges[0])] = 0
+        out[values > edges[-1]] = len(edges)
+        return out
+
+    def histogram(self, mask=None):
+        """(counts, x edges, y edges) of pixels inside the ranges where mask is set, like np.histogram2d."""
+        index = self.index if mask is None else self.index[np.asarray(mask).ravel()]
+        counts = np.zeros(self.size, dtype=np.int64)
+        for i in range(0, index.size, CHUNK_PIXELS):
+            counts += np.bincount(index[i:i + CHUNK_PIXELS], minlength=self.size)
+        counts = counts.reshape(self.steps[0] + 2, self.steps[1] + 2)[1:-1, 1:-1]
+        return counts, self.edges[0], self.edges[1]
+
+    def lookup(self, table):
+        """Value of table (one entry, or a row of them, per bin) at the bin of every pixel, in the shape of the
+        channels. Pixels out of the ranges take the nearest bin, as Mask.get_value classifies them."""
+        table = np.asarray(table)
+        margin = np.pad(table, [(1, 1), (1, 1)] + [(0, 0)] * (table.ndim - 2), mode='edge')
+        flat = margin.reshape(self.size, *table.shape[2:])
+        return np.take(flat, self.index, axis=0).reshape(*self.shape, *table.shape[2:])
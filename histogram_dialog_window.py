@@ -1,5 +1,4 @@
 import tkinter as tk
-import numpy as np
 from PIL.ImageTk import PhotoImage
 
 from histogram_window import HistogramWindow
@@ -65,12 +64,11 @@ class HistogramDialogWindow:
             e.bind('<Return>', self.reload_graphs)
 
     def _calc_ranges(self, _ev=None):
-        values = self.map_image.get_bands(self.map_window.channels_histogram)
-        self.x_range, self.y_range = ([values[i].min(), values[i].max()] for i in range(2))
-
-        for i in range(2):
-            values[i][values[i] < values[i].min() + 0.00000001] = np.nan
-        self.graphs = [plot_hist(values[i]) for i in range(2)]
+        channels = self.map_window.channels_histogram
+        values = self.map_image.get_bands(channels, native=True)
+        stats = [self.map_image.channel_histogram(c, v) for c, v in zip(channels, values)]
+        self.x_range, self.y_range = ([float(v_min), float(v_max)] for v_min, v_max, _ in stats)
+        self.graphs = [plot_hist(counts, low, high) for _, _, (low, high, counts) in stats]
 
     def _add_left_menu(self):
         self.left_menu = tk.Frame(self.root, width=400, bg='red')
@@ -138,10 +136,8 @@ class HistogramDialogWindow:
             self.steps_entries[i].delete(0, 'end')
             self.steps_entries[i].insert(0, self.steps[i])
 
-        values = self.map_image.get_bands(self.map_window.channels_histogram)
-        self.hist = np.histogram2d(values[0].flatten(), values[1].flatten(),
-                                   bins=self.steps,
-                                   range=[self.x_range, self.y_range])
+        self.hist = self.map_image.bin_index(self.map_window.channels_histogram, self.x_range, self.y_range,
+                                             self.steps).histogram()
 
         self.base_image = plot_hist2d(self.hist[0])
 
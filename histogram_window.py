@@ -9,7 +9,8 @@ from tkinter.messagebox import showwarning
 import numpy as np
 from PIL import Image, ImageTk
 
-from utils import Mask, plot_hist2d, AugmentedLabelFrame, TabPolygonImage, keycode2char, geometry_histogram
+from utils import Mask, plot_hist2d, AugmentedLabelFrame, TabPolygonImage, keycode2char, window_geometry, \
+    complete_polygons
 
 from segcanvas.wrappers import FocusLabelFrame
 
@@ -20,7 +21,7 @@ class HistogramWindow:
         self.root = tk.Toplevel(self.app)
         self.root.protocol("WM_DELETE_WINDOW", self.quit)
         self.root.title('SoilRegion (Region)')
-        self.root.geometry("%dx%d%+d%+d" % geometry_histogram)
+        self.root.geometry("%dx%d%+d%+d" % window_geometry()[1])
         self.map_window = map_window
         self.hist = hist
 
@@ -33,7 +34,11 @@ class HistogramWindow:
         self.base_image = base_image or plot_hist2d(hist[0])
         self._add_canvas_frame()
         self.canvas_image.reload_image(self.base_image)
+        self.canvas_image.register_edit_callback(self.map_window.delayed_save_session)
         self._load_colors(load_path='colors.json')
+        region = self.map_window.session_region
+        if region is not None and region['channels'] == self.map_window.channels_histogram:
+            self.load_region(region)
 
         self.root.bind('<Shift_L>', self.on_shift)
         self.root.bind('<KeyRelease>', self.redraw)
@@ -150,6 +155,7 @@ class HistogramWindow:
 
     def quit(self, _ev=None):
         if messagebox.askyesno(title="Quit?", message="Closing window may cause data loss."):
+            self.map_window.session_region = self.region()
             delattr(self.map_window, 'histogram_window')
             self.map_window.map_image.filtered_image = None
             self.root.destroy()
@@ -159,26 +165,48 @@ class HistogramWindow:
         load_path = tk_filedialog.Open(self.root, filetypes=[('', '*.json')]).show()
         if not isinstance(load_path, str) or load_path == '':
             return
+        q = json.load(open(load_path, 'r'))
+        if q['channels'] != self.map_window.channels_histogram:
+            showwarning('Warning', 'Cannot load region with wrong channels!')
+            return
+        self.load_region(q)
+        self.map_window.delayed_save_session()
+
+    def load_region(self, q):
+        """Load polygons of a region saved on (possibly) another histogram grid."""
         x_min, x_max = self.hist[1][0], self.hist[1][-1]
         x_step = self.hist[1][1] - self.hist[1][0]
         y_min, y_max = self.hist[2][0], self.hist[2][-1]
         y_step = self.hist[2][1] - self.hist[2][0]
-        channels = self.map_window.channels_histogram
 
-        q = json.load(open(load_path, 'r'))
-        if q['channels'] != channels:
-            showwarning('Warning', 'Cannot load region with wrong channels!')
-            return
-        for channel_polygons in q['polygons']:
+        polygons = [[[list(v) for v in p] for p in channel_polygons] for channel_polygons in q['polygons']]
+        for channel_polygons in polygons:
             for p in channel_polygons:
                 for v in p:
                     v[0] = min(max(int((q['x_min'] + v[0] * q['x_step'] - x_min) / x_step), 0), self.shape[0] - 1)
                     v[1] = min(max(int((q['y_min'] + v[1] * q['y_step'] - y_min) / y_step), 0), self.shape[1] - 1)
-        self.canvas_image.polygons = q['polygons']
+        self.canvas_image.polygons = polygons
         for i in reversed(range(len(self.canvas_image.polygons))):
+            self.canvas_image.update_movables(i)
             self.canvas_image.update_raster(i)
         self.canvas_image.to_tab(0)
 
+    def region(self):
+        x_min, x_max = float(self.hist[1][0]), float(self.hist[1][-1])
+        x_step = float(self.hist[1][1] - self.hist[1][0])
+        y_min, y_max = float(self.hist[2][0]), float(self.hist[2][-1])
+        y_step = float(self.hist[2][1] - self.hist[2][0])
+        return {
+            'channels': self.map_window.channels_histogram,
+            'x_min': x_min,
+            'x_max': x_max,
+            'x_step': x_step,
+            'y_min': y_min,
+            'y_max': y_max,
+            'y_step': y_step,
+            'polygons': [complete_polygons(p) for p in self.canvas_image.polygons]
+        }
+
     def save_file(self, _ev):
         fn = tk_filedialog.SaveAs(self.root, initialfile=f'{self.map_window.img_name}_region.json',
                                   filetypes=[('*.json files', '*.json')]).show()
@@ -186,21 +214,7 @@ class HistogramWindow:
             return
         if not fn.endswith('.json'):
             fn += '.json'
-        x_min, x_max = self.hist[1][0], self.hist[1][-1]
-        x_step = self.hist[1][1] - self.hist[1][0]
-        y_min, y_max = self.hist[2][0], self.hist[2][-1]
-        y_step = self.hist[2][1] - self.hist[2][0]
-        channels = self.map_window.channels_histogram
-        json.dump({
-            'channels': channels,
-            'x_min': x_min,
-            'x_max': x_max,
-            'x_step': x_step,
-            'y_min': y_min,
-            'y_max': y_max,
-            'y_step': y_step,
-            'polygons': self.canvas_image.polygons
-        }, open(fn, 'w'), indent=4)
+        json.dump(self.region(), open(fn, 'w'), indent=4)
 
     def on_shift(self, _arg):
         self.canvas_image.patch_image(self.base_image)
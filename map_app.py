@@ -1,3 +1,4 @@
+import copy
 import json
 import tkinter as tk
 from functools import partial
@@ -7,15 +8,22 @@ from tkinter import messagebox
 
 import os.path
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from osgeo import gdal
 import numpy as np
 from PIL import Image
-from scipy.interpolate import interp2d
 
+from band_math import Formula, FormulaBand, FormulaError
+from bands import LazyBand, BandCache, DEFAULT_CACHE_BYTES, compute_dtype, read_only
+from display import LutImage
+from export import write_classified
+from histogram import BinIndex, ValueHistogram, bin_counts
 from histogram_dialog_window import HistogramDialogWindow
+from resample import fit
+from session_cache import SessionCache
 from utils import string_to_value, get_color, SATELLITE_CHANNELS, TabPolygonImage, load_proj, keycode2char, \
-    geometry_map, copy_list
+    window_geometry, complete_polygons
 
 from segcanvas.wrappers import FocusLabelFrame
 
@@ -39,7 +47,7 @@ class MapWindow:
         self.root = app
         self.root.protocol("WM_DELETE_WINDOW", self.quit)
         self.root.title('SoilRegion (Map)')
-        self.root.geometry("%dx%d%+d%+d" % geometry_map)
+        self.root.geometry("%dx%d%+d%+d" % window_geometry()[0])
 
         self.channels_img = ['07', '04', '02']
         self.channels_histogram = None
@@ -47,11 +55,15 @@ class MapWindow:
         self.range = None
         self.n_regions = 5
         self.colors = np.array([[0, 0, 0], [255, 0, 0], [0, 255, 0], [0, 0, 255], [0, 255, 255], [255, 0, 255]])
+        self.session_region = None  # region of the histogram window restored from the session cache
+        self._save_session_job = None
+        self._export = None  # thread writing the classified mask
 
         self._add_top_menu()
         self._add_status_bar()
         self._add_canvas_frame()
         self.map_image = MapImage(self.colors)
+        self.map_image.progress_callback = self._show_progress
 
         self.root.bind('<Shift_L>', self.on_shift)
         self.root.bind('<KeyRelease>', self.redraw)
@@ -66,6 +78,8 @@ class MapWindow:
         self.status_bar.pack(side='bottom', fill='x')
         self.status_pos = tk.Label(self.status_bar, width=22, borderwidth=2, relief="groove")
         self.status_pos.pack(side='right')
+        self.status_progress = tk.Label(self.status_bar, width=30, borderwidth=2, relief="groove", anchor='w')
+        self.status_progress.pack(side='left')
 
     def _add_top_menu(self):
         self.top_menu = tk.Frame(self.root, height=60, bg='gray')
@@ -124,6 +138,7 @@ class MapWindow:
         self.canvas_image = MapTabImage(self.canvas_frame, self.canvas, self.root,
                                         Image.fromarray(np.zeros([80, 80, 3]), mode='RGB'), self.colors, 2)
         self.canvas_image.canvas.bind('<Motion>', self._motion)
+        self.canvas_image.register_edit_callback(self.delayed_save_session)
         self.canvas_image.tab = 0
 
     def quit(self, _ev=None):
@@ -216,15 +231,13 @@ class MapWindow:
         if self.polygon_or_mask_state == 'polygon':
             map_mask = (self.canvas_image.rasters[self.canvas_image.tab] > 0)[:, ::-1].transpose()
         elif self.polygon_or_mask_state == 'mask':
-            map_mask = self.map_image.get_bands(['_map_mask_'], shape=self.map_image.original_array.shape[:2])[0]
+            map_mask = self.map_image.get_bands(['_map_mask_'], shape=self.map_image.original_shape)[0]
             map_mask = map_mask > self.mask_threshold_slider.get()
 
         base_array = np.array(self.histogram_window.base_image).transpose([1, 0, 2])
-        values = self.map_image.get_bands(self.channels_histogram, shape=self.map_image.original_array.shape[:2])
-        values = [arr * map_mask for arr in values]
-        hist = np.histogram2d(values[0][map_mask].flatten(), values[1][map_mask].flatten(),
-                              bins=self.steps, range=self.range)
-        hist = hist[0]
+        index = self.map_image.bin_index(self.channels_histogram, *self.range, self.steps,
+                                         shape=self.map_image.original_shape)
+        hist = index.histogram(map_mask)[0]
         mask = hist > 0
         mask = mask[:, ::-1]
         mask = np.array([mask] * 3, dtype=float).transpose([1, 2, 0])
@@ -262,6 +275,7 @@ class MapWindow:
 
     def reload_channels(self, _ev=None, channels=None):
         logger.info(f'channels={channels}')
+        previous = list(self.channels_img)
         for i in range(3):
             if channels:
                 self.channels_img[i] = channels[i]
@@ -269,10 +283,14 @@ class MapWindow:
                 self.channels_img[i] = string_to_value(self.ch_stringvars[i].get()) or self.channels_img[i]
             self.ch_entries[i].delete(0, 'end')
             self.ch_entries[i].insert(0, self.channels_img[i].lstrip('0'))
-        if self.map_image.original_image is not None:
+        if self.map_image.original_image is None:
+            return
+        if self.channels_img == previous and self.map_image.update_stretch(self.slider.get()):
+            self.canvas_image.refresh_base_image()  # only lookup tables changed, visible area is rendered again
+        else:
             self.map_image.create_original_img(self.channels_img, self.slider.get())
             self.canvas_image.reload_image(self.map_image.original_image, True)
-            self.redraw()
+        self.redraw()
 
     def update_mask_threshold(self, ev=None, value=None):
         logger.info(f'value={value}')
@@ -298,11 +316,35 @@ class MapWindow:
             self.reload_channels(channels=[self.map_image.chan_dict_rev[c] for c in ['swir2', 'nir', 'green']])
             self.map_image.create_original_img(self.channels_img, self.slider.get())
             self.canvas_image.reload_image(self.map_image.original_image, True)
+            self._restore_session()
         elif isinstance(img_path, str) and img_path.endswith('.tif'):
             logger.info('loading mask')
             self.map_image.load_band('_map_mask_', img_path)
             self.redraw()
 
+    def _restore_session(self):
+        state = self.map_image.session.load_json('polygons', {'map': [[] for _ in self.canvas_image.polygons]})
+        logger.info(f'restoring {sum(map(len, state["map"]))} polygons')
+        self.session_region = state.get('region')
+        self.canvas_image.polygons = state['map']
+        for n in reversed(range(self.canvas_image.n_tabs)):
+            self.canvas_image.update_movables(n)
+            self.canvas_image.update_raster(n)
+        self.canvas_image.to_tab(self.canvas_image.tab)
+
+    def delayed_save_session(self):
+        if self._save_session_job:
+            self.root.after_cancel(self._save_session_job)
+        self._save_session_job = self.root.after(1000, self.save_session)
+
+    def save_session(self):
+        logger.info('')
+        self._save_session_job = None
+        if hasattr(self, 'histogram_window'):
+            self.session_region = self.histogram_window.region()
+        polygons = [complete_polygons(p) for p in self.canvas_image.polygons]
+        self.map_image.session.save_json('polygons', {'map': polygons, 'region': self.session_region})
+
     def save_file(self, _ev):
         logger.info('')
         fn = tk_filedialog.SaveAs(self.root, initialfile=f'{self.img_name}_mask.tif',
@@ -312,20 +354,45 @@ class MapWindow:
         if not fn.endswith('.tif'):
             fn += '.tif'
 
-        band = list({'blue', 'green', 'red', 'nir', 'swir1', 'swir2'} & self.map_image.bands.keys())[0]
-        gt = self.map_image.meta_dict[band]['geotransform']
-        proj = self.map_image.meta_dict[band]['projection']
-        shape = self.map_image.bands[band].shape
+        if self._export is not None and self._export.is_alive():
+            messagebox.showinfo(title='Saving', message='Previous mask is still being saved.')
+            return
 
-        arrays = self.map_image.get_bands(self.map_image.histogram_mask.channels, shape=shape)
-        types = self.map_image.histogram_mask.get_value(*tuple(arrays))
+        band = self.map_image.reference_band()
+        mask = copy.copy(self.map_image.histogram_mask)  # polygons may be edited while the file is written
+        mask.update_array(mask.array.copy())
+        sources = [self.map_image.source_band(c) for c in mask.channels]
+        meta = self.map_image.meta_dict[band]
+        self._export_progress = (0, 1)
+        self._export_error = None
+        self._export = threading.Thread(target=self._write_mask, daemon=True,
+                                        args=(fn, sources, mask, self.map_image.bands[band].shape, meta))
+        self._export.start()
+        self._poll_export(os.path.basename(fn))
+
+    def _write_mask(self, fn, sources, mask, shape, meta):
+        try:
+            write_classified(fn, sources, mask, shape, meta['geotransform'], meta['projection'],
+                             progress=lambda done, total: setattr(self, '_export_progress', (done, total)))
+        except Exception as e:
+            self._export_error = e
+
+    def _poll_export(self, name):
+        """Show progress of the background export, tkinter must only be used from the main thread."""
+        if self._export.is_alive():
+            self._show_progress('saving', name, *self._export_progress)
+            self.root.after(200, self._poll_export, name)
+            return
+        self._show_progress('saving', name, 1, 1)
+        if self._export_error is not None:
+            logger.error(f'saving {name} failed: {self._export_error}')
+            messagebox.showerror(title='Saving failed', message=str(self._export_error))
+        else:
+            logger.info(f'saved {name}')
 
-        driver = gdal.GetDriverByName("GTiff")
-        outdata = driver.Create(fn, types.shape[1], types.shape[0], 1, gdal.GDT_UInt16)
-        outdata.SetGeoTransform(gt)
-        outdata.SetProjection(proj)
-        outdata.GetRasterBand(1).WriteArray(types)
-        outdata.FlushCache()  # saves to disk
+    def _show_progress(self, action, name, done, total):
+        self.status_progress['text'] = f'{action} {name} ({done}/{total})' if done < total else ''
+        self.status_bar.update_idletasks()
 
     def on_shift(self, _ev):
         logger.info('')
@@ -339,7 +406,7 @@ class MapWindow:
         elif self.polygon_or_mask_state == 'polygon':
             img = self.canvas_image.crafted_image
         else:  # self.polygon_or_mask_state == 'mask'
-            map_mask = self.map_image.get_bands(['_map_mask_'], shape=self.map_image.original_array.shape[:2])[0]
+            map_mask = self.map_image.get_bands(['_map_mask_'], shape=self.map_image.original_shape)[0]
             map_mask = np.array(map_mask > self.mask_threshold_slider.get(), dtype=int)
             colors = get_color(map_mask, self.colors)
             filtered_image_array = (self.map_image.original_array * 0.5 + colors * 0.5).astype('uint8')
@@ -412,66 +479,115 @@ class MapTabImage(TabPolygonImage):
         if self.tab != 0:
             return super()._left_mouse_moving(event)
 
-    def _create_crafted_image(self, n):
-        raster = self.rasters[n][:, ::-1]
-        crafted_image_array = get_color(raster, self.colors)
+    def _create_crafted_image(self, n, bbox=None):
         if n == 0:
-            crafted_image_array = self.base_array
-        else:
-            mask = np.array([raster == 0] * 3).transpose([1, 2, 0])
-            crafted_image_array = crafted_image_array * (1 - mask) + self.base_array * mask
-        self.crafted_image = Image.fromarray(crafted_image_array.astype('uint8').transpose(1, 0, 2))
+            self.crafted_image = self.base_image
+            self._crafted_tab = None  # the base image itself is never drawn on
+            return None
+        return super()._create_crafted_image(n, bbox)
 
 
 class MapImage:
-    def __init__(self, colors):
+    def __init__(self, colors, cache_dir=None, cache_bytes=DEFAULT_CACHE_BYTES):
         self.colors = colors
         self.bands = None
         self.map_mask = None  # mask on the map
         self.histogram_mask = None  # mask in histogram space
         self.original_image = None
-        self.original_array = None
+        self._original_array = None
+        self._display = None  # channels, bands and histograms of the image displayed through lookup tables
         self.filtered_image = None
         self.meta_dict = dict()
         self.img_name = None
-        self._buffer_for_get_bands = dict()
+        self.chan_dict = dict()  # band number -> name, of the satellite of the loaded scene
+        self.chan_dict_rev = dict()
+        self._buffer_for_get_bands = BandCache(cache_bytes)
+        self.session = SessionCache(cache_dir)
+        self.progress_callback = None  # called with (action, band, done, total) while bands are read
+        self.stretch_stats = dict()
 
         self.channel_formulas = dict()
+        self._formulas_mtime = None
+        self._histograms = dict()  # (channel, shape) -> ValueHistogram
+        self._derived = dict()  # formula channel -> formula of its cached results, whose bands they depend on
 
     def load_band(self, b, img_path):
+        opened = self._open_band(b, img_path)
+        if opened is not None:
+            self._set_band(b, *opened)
+
+    def _open_band(self, b, img_path):
+        """Open band b from img_path, safe to run in a worker thread."""
         if not os.path.isfile(img_path):
-            return
+            return None
+        from osgeo import gdal  # loaded with the first scene rather than at startup
+
         ds = gdal.Open(img_path)
         if ds is None:
-            return
-        for (x, y, channels) in list(self._buffer_for_get_bands.keys()):
-            if b in self.chan_dict_rev and self.chan_dict_rev[b] in channels:
-                self._buffer_for_get_bands.pop((x, y, channels))
-            if b in channels:
-                self._buffer_for_get_bands.pop((x, y, channels))
-        band = ds.GetRasterBand(1)
+            return None
+        if b == '_map_mask_':
+            return ds.GetRasterBand(1).ReadAsArray(), None
+        cached = self.session.load_array(f'band_{b}')
+        meta = {'geotransform': ds.GetGeoTransform(), 'projection': ds.GetProjection()}
+        return (cached if cached is not None else LazyBand(img_path, ds)), meta
+
+    def _set_band(self, b, band, meta):
+        self._drop_cached({self.chan_dict_rev.get(b), b} | {c for c, f in self._derived.items() if b in f.bands})
         if b == '_map_mask_':
             # todo assert same projection and geotranform
-            self.map_mask = band.ReadAsArray().astype(float)
+            self.map_mask = band
         else:
-            self.bands[b] = band.ReadAsArray().astype(float)
-            self.meta_dict[b] = {'geotransform': ds.GetGeoTransform(), 'projection': ds.GetProjection()}
+            self.bands[b] = band
+            self.meta_dict[b] = meta
 
     def load(self, img_path):
         img_prefix = self._get_img_name(img_path)
         self.img_name = img_prefix.split('/')[-1]
         self.bands = dict()
+        self.original_image = None  # display image and lookup tables of the previous scene must not be restretched
+        self._original_array = None
+        self._display = None
+        self.filtered_image = None
         if img_prefix != '':
-            for n, c in self.chan_dict.items():
-                self.load_band(c, f'{img_prefix}_{c}_{n}.tif')
+            paths = {c: f'{img_prefix}_{c}_{n}.tif' for n, c in self.chan_dict.items()}
+            self.session.open([p for p in paths.values() if os.path.isfile(p)])
+            self.stretch_stats = self.session.load_json('stretch', dict())
+            with ThreadPoolExecutor(max_workers=min(len(paths), os.cpu_count() or 1)) as pool:
+                futures = {pool.submit(self._open_band, c, p): c for c, p in paths.items()}
+                for done, future in enumerate(as_completed(futures), 1):
+                    if future.result() is not None:
+                        self._set_band(futures[future], *future.result())
+                    self._report_progress('opening', futures[future], done, len(futures))
+
+    def _report_progress(self, action, name, done, total):
+        if self.progress_callback is not None:
+            self.progress_callback(action, name, done, total)
 
     def load_formulas(self, f='formulas.json'):
-        formulas = json.load(open(f))['formulas']
-        for v in formulas.values():
-            if '__' in v or '[' in v or '{' in v or '\'' in v or '"' in v or 'import' in v:
-                logger.error('Formula not safe to eval')
-                return
-        self.channel_formulas = formulas
+        """Compile formulas of f, parsed again only when the file is modified."""
+        mtime = os.stat(f).st_mtime_ns
+        if mtime == self._formulas_mtime:
+            return
+        self._formulas_mtime = mtime
+        band_names = {b for channels in SATELLITE_CHANNELS.values() for b in channels.values()}
+        self.channel_formulas = dict()
+        for channel, text in json.load(open(f))['formulas'].items():
+            try:
+                self.channel_formulas[channel] = Formula(text, band_names)
+            except FormulaError as e:
+                logger.error(e)
+        self._drop_cached({c for c, f in self._derived.items()
+                           if c not in self.channel_formulas or self.channel_formulas[c].text != f.text})
+
+    def _drop_cached(self, channels):
+        """Forget buffered arrays of channels, at any shape."""
+        for (x, y, channel) in self._buffer_for_get_bands.keys():
+            if channel in channels or isinstance(channel, tuple) and channels & set(channel[1]):  # bin indexes
+                self._buffer_for_get_bands.pop((x, y, channel))
+        for c in channels:
+            self._derived.pop(c, None)
+        for key in [key for key in self._histograms if key[0] in channels]:
+            del self._histograms[key]
 
     def get_band(self, channel):
         if channel in self.chan_dict:
@@ -479,22 +595,46 @@ class MapImage:
         elif channel == '_map_mask_':
             return self.map_mask
         else:
-            logger.info('Channel not found, applying formula')
             self.load_formulas()
-            locals_ = {'np': np}
-            locals_.update(self.bands)
-            res = eval(self.channel_formulas[channel], locals_)
+            formula = self.channel_formulas[channel]
+            key = (*formula.shape(self.bands), channel)
+            res = self._buffer_for_get_bands.get(key)
+            if res is None:
+                logger.info('Channel not found, applying formula')
+                res = self._buffer_for_get_bands.put(key, formula.evaluate(self.bands))
+                self._derived[channel] = formula
             return res
 
-    def get_bands(self, channels, downsample=1, shape=None):
-        """downsample!=False will make all bands having shape of smallest // downsample."""
-        arrays = [self.get_band(c).copy() for c in channels]
+    def source_band(self, channel):
+        """Band, mask or lazily computed formula of a channel, rows of which can be read by slicing."""
+        if channel in self.chan_dict or channel == '_map_mask_':
+            return self.get_band(channel)
+        self.load_formulas()
+        return FormulaBand(self.channel_formulas[channel], dict(self.bands))
+
+    def reference_band(self):
+        """Name of a loaded band whose grid and georeference are used for exports."""
+        return list({'blue', 'green', 'red', 'nir', 'swir1', 'swir2'} & self.bands.keys())[0]
 
+    def _channel_shape(self, channel):
+        if channel in self.chan_dict:
+            return self.bands[self.chan_dict[channel]].shape
+        elif channel == '_map_mask_':
+            return self.map_mask.shape
+        else:
+            self.load_formulas()
+            return self.channel_formulas[channel].shape(self.bands)
+
+    def get_bands(self, channels, downsample=1, shape=None, native=False):
+        """downsample!=False will make all bands having shape of smallest // downsample.
+        Returns read-only arrays, promoted to compute dtype unless native=True."""
+        if set(channels) - self.chan_dict.keys() - {'_map_mask_'}:
+            self.load_formulas()  # buffered results of formula channels are dropped if formulas.json changed
         if not shape:
             if not downsample:
-                return arrays
+                return self._hand_out([self.get_band(c) for c in channels], native)
 
-            shapes = np.array([a.shape for a in arrays])
+            shapes = np.array([self._channel_shape(c) for c in channels])
             x = shapes[:, 0].min()
             y = shapes[:, 1].min()
 
@@ -504,69 +644,197 @@ class MapImage:
         else:
             x, y = shape
 
-        if (x, y, tuple(channels)) in self._buffer_for_get_bands:
-            return copy_list(self._buffer_for_get_bands[(x, y, tuple(channels))])
-
-        for i in range(len(arrays)):
-            a = arrays[i]
-            no_interpolation = True
-
-            if a.shape[0] % x <= x // 100:
-                a = a[::a.shape[0] // x][:x]
-            elif a.shape[0] % x >= x - x // 100:
-                a = a[::a.shape[0] // x + 1][:x]
-            else:
-                no_interpolation = False
-
-            if a.shape[1] % y <= y // 100:
-                a = a[:, ::a.shape[1] // y][:, :y]
-            elif a.shape[1] % y >= y - y // 100:
-                a = a[:, ::a.shape[1] // y + 1][:, :y]
+        cached = {c: self._buffer_for_get_bands.get((x, y, c)) for c in set(channels) & self.chan_dict.keys()}
+        missing = sorted(c for c, a in cached.items() if a is None)
+        if missing:
+            cached.update(self._load_resampled_bands(missing, x, y))
+            logger.info(f'band cache {self._buffer_for_get_bands.stats()}')
+
+        arrays = []
+        for c in channels:
+            if c in cached:
+                arrays.append(cached[c])
+            elif c in self.channel_formulas:
+                arrays.append(self._resampled_formula(c, x, y))
             else:
-                no_interpolation = False
+                arrays.append(fit(self.get_band(c), (x, y)))
+        return self._hand_out(arrays, native)
+
+    def _resampled_formula(self, c, x, y):
+        """Formula channel resampled to (x, y), kept in the buffer like raw bands."""
+        res = self._buffer_for_get_bands.get((x, y, c))
+        if res is None:
+            res = self.get_band(c)
+            if res.shape != (x, y):
+                res = self._buffer_for_get_bands.put((x, y, c), fit(res, (x, y)))
+        return res
+
+    def _load_resampled_bands(self, channels, x, y):
+        """Read and resample channels to (x, y) in parallel, GDAL releases the GIL while decoding."""
+        arrays = dict()
+        with ThreadPoolExecutor(max_workers=min(len(channels), os.cpu_count() or 1)) as pool:
+            futures = {pool.submit(self._load_resampled, self.chan_dict[c], x, y): c for c in channels}
+            for done, future in enumerate(as_completed(futures), 1):
+                c = futures[future]
+                arrays[c] = self._buffer_for_get_bands.put((x, y, c), future.result())
+                if (x, y) == self.bands[self.chan_dict[c]].shape:  # keep decoded band instead of reading it again
+                    self.bands[self.chan_dict[c]] = future.result()
+                self._report_progress('reading', self.chan_dict[c], done, len(futures))
+        return arrays
 
-            if not no_interpolation:
-                a = interp2d(np.linspace(0, 1, a.shape[1]),
-                             np.linspace(0, 1, a.shape[0]),
-                             a, kind='cubic')(np.linspace(0, 1, y), np.linspace(0, 1, x))
+    def cache_stats(self):
+        return self._buffer_for_get_bands.stats()
 
-            arrays[i] = a
+    def _load_resampled(self, b, x, y):
+        """Band b resampled to (x, y), shared through the session cache."""
+        name = f'band_{b}' if (x, y) == self.bands[b].shape else f'{b}_{x}x{y}'
+        a = self.session.load_array(name)
+        if a is None:
+            a = self.session.save_array(name, fit(self.bands[b], (x, y)))
+        return a
 
-        if set(channels) <= self.chan_dict.keys():
-            self._buffer_for_get_bands[(x, y, tuple(channels))] = copy_list(arrays)
-        return arrays
+    @staticmethod
+    def _hand_out(arrays, native):
+        return [read_only(np.asarray(a) if native else np.asarray(a, dtype=compute_dtype())) for a in arrays]
 
     def create_original_img(self, b, r=0):
-        arrays = self.get_bands(b)
-        if len(arrays) == 1:
-            arrays *= 3
-        if len(arrays) == 2:
-            arrays += [np.zeros_like(arrays[0])]
-        assert len(arrays) == 3
+        natives = self.get_bands(b, native=True)
+        if len(natives) == 1:
+            natives *= 3
+        if len(natives) == 2:
+            natives += [np.zeros_like(natives[0])]
+        assert len(natives) == 3
+
+        channels = b * 3 if len(b) == 1 else b + [None] * (3 - len(b))
+        hists = [self._get_histogram(c, a) for c, a in zip(channels, natives)]
+        self._original_array = None
+        if all(hist is not None for hist in hists):  # integer bands are displayed through lookup tables
+            self._display = (channels, natives, hists)
+            self.original_image = LutImage(natives, self._stretch_luts(r))
+            return
 
+        self._display = None
+        arrays = [np.asarray(a, dtype=compute_dtype()) for a in natives]  # promoted only when stretched here
         for i in range(len(arrays)):
-            arr = arrays[i]
+            low, high = self._stretch_range(channels[i], arrays[i], hists[i], r)
+            arrays[i] = self._stretch(arrays[i], low, high, hists[i])
+        self.original_image = Image.fromarray(np.array(arrays).transpose([1, 2, 0]), mode='RGB')
 
-            low, high = np.quantile(arr.flatten(), .01), np.quantile(arr.flatten(), .99)
+    def update_stretch(self, r):
+        """Restretch the display image in place, False if it is not displayed through lookup tables."""
+        if self._display is None:
+            return False
+        self.original_image.set_luts(self._stretch_luts(r))
+        self._original_array = None
+        return True
+
+    def _stretch_luts(self, r):
+        luts = []
+        for channel, native, hist in zip(*self._display):
+            low, high = self._stretch_range(channel, native, hist, r)
+            luts.append(self._stretch(np.arange(hist.counts.size, dtype=compute_dtype()), low, high, hist))
+        return luts
+
+    def _stretch_range(self, channel, arr, hist, r):
+        low, high, mean = self._get_stretch_stats(channel, arr, hist)
+        return mean + (low - mean) * 2 ** -r, mean + (high - mean) * 2 ** -r
+
+    @staticmethod
+    def _stretch(arr, low, high, hist=None):
+        """Values of arr clipped to [low, high] and scaled to uint8."""
+        arr = np.clip(arr, low, high)
+        if hist is not None:  # min and max of the clipped band without passes over it
+            arr_min = max(arr.dtype.type(low), hist.min())
+            arr_max = min(arr.dtype.type(high), hist.max())
+        else:
+            arr_min, arr_max = arr.min(), arr.max()
+        return ((arr - arr_min) / (arr_max - arr_min) * 255).astype('uint8')
+
+    @property
+    def original_array(self):
+        """Display image as an array, rendered on first use."""
+        if self._original_array is None and self.original_image is not None:
+            self._original_array = np.array(self.original_image)
+        return self._original_array
+
+    @property
+    def original_shape(self):
+        return self.original_image.height, self.original_image.width
+
+    def _get_histogram(self, channel, native):
+        """Value histogram of an unsigned integer channel at the shape of native, None for other channels."""
+        if native.dtype.kind != 'u' or native.dtype.itemsize > 2:
+            return None
+        key = (channel, native.shape)
+        if key not in self._histograms:
+            hist = ValueHistogram.of(native, compute_dtype())
+            if channel is None:
+                return hist
+            self._histograms[key] = hist
+        return self._histograms[key]
+
+    def channel_histogram(self, channel, values, bins=256):
+        """Minimum and maximum of values of a channel, and counts of `bins` bins over the values above the minimum
+        (usually no data) as (low, high, counts)."""
+        hist = self._get_histogram(channel, values)
+        if hist is not None:
+            v_min, v_max = hist.min(), hist.max()
+            above = hist.between(v_min, v_max + 1)
+            low = above.min() if above.n else v_min
+            return v_min, v_max, (low, v_max, above.bins(low, v_max, bins))
+
+        v_min, v_max = compute_dtype().type(np.nanmin(values)), compute_dtype().type(np.nanmax(values))
+        low = np.min(values, where=values > v_min, initial=v_max)
+        return v_min, v_max, (low, v_max, bin_counts(values, low, v_max, bins))
+
+    def bin_index(self, channels, x_range, y_range, steps, shape=None):
+        """BinIndex of the pixels of two channels at shape (that of the smallest band by default).
+        Indexes are kept in the band buffer, within its memory budget, so histograms of other masks need no binning."""
+        values = self.get_bands(channels, shape=shape, native=True)
+        x_range, y_range, steps = tuple(map(float, x_range)), tuple(map(float, y_range)), tuple(map(int, steps))
+        key = (*values[0].shape, ('bins', tuple(channels), x_range, y_range, steps))
+        index = self._buffer_for_get_bands.get(key)
+        if index is not None:
+            return BinIndex(index, x_range, y_range, steps)
+        index = BinIndex.of(*values, x_range, y_range, steps)
+        self._buffer_for_get_bands.put(key, index.index.reshape(index.shape))
+        return index
+
+    def _get_stretch_stats(self, channel, arr, hist=None):
+        """Robust low, high and mean of a channel, independent of the stretch slider.
+        Computed from the histogram of the channel if it has one, otherwise by sorting arr."""
+        key = f'{channel}_{arr.shape[0]}x{arr.shape[1]}'
+        if key in self.stretch_stats:
+            return self.stretch_stats[key]
+
+        if hist is not None:
+            low, high = hist.quantile(.01), hist.quantile(.99)
+            low, high = low + (high-low) * .01, high - (high-low) * 0.01
+            inner = hist.between(low, high)
+            inner = inner if inner.n else hist
+            stats = [float(inner.quantile(.05)), float(inner.quantile(.95)), inner.mean()]
+        else:
+            low, high = np.quantile(arr, .01), np.quantile(arr, .99)
             low, high = low + (high-low) * .01, high - (high-low) * 0.01
             tmp_arr = arr[(low < arr) * (arr < high)]
+            stats = [float(np.quantile(tmp_arr, .05)), float(np.quantile(tmp_arr, .95)), float(tmp_arr.mean())]
 
-            low, high, mean = np.quantile(tmp_arr, .05), np.quantile(tmp_arr, .95), tmp_arr.mean()
-            low, high = mean + (low - mean) * 2 ** -r, mean + (high - mean) * 2 ** -r
-            arr[arr < low] = low
-            arr[arr > high] = high
-
-            arrays[i] = ((arr - arr.min()) / (arr.max() - arr.min()) * 255).astype('uint8')
-        self.original_image = Image.fromarray(np.array(arrays).transpose([1, 2, 0]), mode='RGB')
-        self.original_array = np.array(self.original_image)
+        if channel in self.chan_dict:
+            self.stretch_stats[key] = stats
+            self.session.save_json('stretch', self.stretch_stats)
+        return stats
 
     def create_filtered_image(self):
-        arrays = self.get_bands(self.histogram_mask.channels, shape=self.original_array.shape[:2])
-
-        types = self.histogram_mask.get_value(*tuple(arrays))
-        colors = get_color(types, self.colors)
-        filtered_image_array = (self.original_array * 0.5 + colors * 0.5).astype('uint8')
-        self.filtered_image = Image.fromarray(filtered_image_array, mode='RGB')
+        """Display image blended half and half with the colors of classes of the histogram mask.
+        Pixels are classified by their cached histogram bins, through a color of each bin."""
+        mask = self.histogram_mask
+        index = self.bin_index(mask.channels, (mask.x_min, mask.x_max), (mask.y_min, mask.y_max), mask.array.shape,
+                               shape=self.original_shape)
+        bin_colors = np.asarray(self.colors, dtype=np.uint16)[np.asarray(mask.array, dtype=np.uint8)]
+        filtered_image_array = index.lookup(bin_colors)
+        filtered_image_array += self.original_array
+        filtered_image_array >>= 1
+        self.filtered_image = Image.fromarray(filtered_image_array.astype(np.uint8), mode='RGB')
 
     def _get_img_name(self, img_path):
         if not self.validate_img_path(img_path):
@@ -0,0 +1,128 @@
+import numpy as np
+
+from bands import compute_dtype
+
+CHUNK_BYTES = 32 * 2 ** 20  # approximate size of source rows processed at once
+
+
+def choose_mode(n_src, n_out):
+    """Resampling kernel for an axis of n_src samples resampled to n_out."""
+    if n_src >= 2 * n_out:
+        return 'block'
+    if n_out % n_src == 0:
+        return 'nearest'
+    return 'separable'
+
+
+def _cubic(d):
+    """Keys cubic convolution kernel (a=-0.5)."""
+    d = np.abs(d)
+    return np.where(d <= 1, (1.5 * d - 2.5) * d * d + 1,
+                    np.where(d < 2, ((-0.5 * d + 2.5) * d - 4) * d + 2, 0))
+
+
+def _taps(n_src, n_out, mode):
+    """Source indices and weights (both n_out x k) of a 1-dimensional resampling."""
+    i = np.arange(n_out)
+    if mode == 'nearest':
+        return ((2 * i + 1) * n_src // (2 * n_out))[:, None], np.ones((n_out, 1))
+    if mode == 'block':  # average of source pixels covered by output pixel, weighted by overlap
+        ratio = n_src / n_out
+        start = i * ratio
+        idx = np.floor(start).astype(int)[:, None] + np.arange(int(np.ceil(ratio)) + 1)
+        w = np.clip(np.minimum(idx + 1, (start + ratio)[:, None]) - np.maximum(idx, start[:, None]), 0, None)
+        return np.minimum(idx, n_src - 1), w / w.sum(axis=1, keepdims=True)
+    if mode == 'separable':  # cubic convolution, end points of both axes are aligned
+        pos = i * (n_src - 1) / max(n_out - 1, 1)
+        idx = np.floor(pos).astype(int)[:, None] + np.arange(-1, 3)
+        w = _cubic(pos[:, None] - idx)
+        return np.clip(idx, 0, n_src - 1), w
+    raise ValueError(f'Unknown resampling mode {mode}')
+
+
+def _apply(src, idx, w, axis):
+    """Weighted sum of source rows (axis=0) or columns (axis=1) given by taps idx and w."""
+    w = w.astype(compute_dtype())
+    res = None
+    for j in range(idx.shape[1]):
+        part = src[idx[:, j]] if axis == 0 else src[:, idx[:, j]]  # fancy indexing returns a copy
+        if idx.shape[1] > 1:
+            part *= w[:, j, None] if axis == 0 else w[:, j]
+        if res is None:
+            res = part
+        else:
+            res += part
+    return res
+
+
+def resample(a, shape, mode=None):
+    """Resample 2-dimensional array (or lazy band) `a` to `shape`.
+    Each axis uses `mode` ('nearest', 'block' or 'separable') or the one chosen by its scale factor.
+    Output is computed by chunks of rows, only source rows needed for a chunk are read at once."""
+    out = np.empty(shape, dtype=compute_dtype())
+    row_taps = _taps(a.shape[0], shape[0], mode or choose_mode(a.shape[0], shape[0]))
+    col_taps = _taps(a.shape[1], shape[1], mode or choose_mode(a.shape[1], shape[1]))
+    src_rows_per_row = a.shape[0] / shape[0] + row_taps[0].shape[1]
+    chunk = max(1, int(CHUNK_BYTES // (max(a.shape[1], shape[1]) * out.itemsize * src_rows_per_row)))
+    for r0 in range(0, shape[0], chunk):
+        out[r0:r0 + chunk] = _resample_rows(a, row_taps, col_taps, r0, r0 + chunk)
+    return out
+
+
+def resample_rows(a, shape, r0, r1, mode=None):
+    """Rows r0:r1 of resample(a, shape, mode), reading only the source rows they need."""
+    return _resample_rows(a, _taps(a.shape[0], shape[0], mode or choose_mode(a.shape[0], shape[0])),
+                          _taps(a.shape[1], shape[1], mode or choose_mode(a.shape[1], shape[1])), r0, r1)
+
+
+def _resample_rows(a, row_taps, col_taps, r0, r1):
+    idx, w = row_taps[0][r0:r1], row_taps[1][r0:r1]
+    lo, hi = idx.min(), idx.max() + 1
+    src = np.asarray(a[lo:hi], dtype=compute_dtype())
+    return _apply(_apply(src, idx - lo, w, 0), *col_taps, 1)
+
+
+def decimation_slice(n, m):
+    """Slice taking m of n elements with a constant step, None if n is not close to a multiple of m."""
+    if n % m <= m // 100:
+        step = n // m
+    elif n % m >= m - m // 100:
+        step = n // m + 1
+    else:
+        return None
+    return slice(0, min(n, step * (m - 1) + 1), step)
+
+
+def fit(a, shape):
+    """`a` brought to shape by taking every k-th row and column where the scale is close to an integer,
+    resampling otherwise. Returns a view of `a` if both axes are decimated."""
+    if decimation_slice(a.shape[0], shape[0]) is None:
+        return resample(_decimated_columns(a, shape[1]), shape)
+    return fit_rows(a, shape, 0, shape[0])
+
+
+def fit_rows(a, shape, r0, r1):
+    """Rows r0:r1 of fit(a, shape), reading only the source rows they need."""
+    rows = decimation_slice(a.shape[0], shape[0])
+    if rows is None:
+        return resample_rows(_decimated_columns(a, shape[1]), shape, r0, r1)
+    cols = decimation_slice(a.shape[1], shape[1])
+    src = a[rows.start + r0 * rows.step:rows.start + (r1 - 1) * rows.step + 1:rows.step, cols or slice(None)]
+    return src if cols is not None else resample(src, (r1 - r0, shape[1]))
+
+
+def _decimated_columns(a, n):
+    cols = decimation_slice(a.shape[1], n)
+    return a if cols is None else _Columns(a, cols)
+
+
+class _Columns:
+    """ Columns cols of a, read when rows of it are sliced """
+
+    def __init__(self, a, cols):
+        self.a = a
+        self.cols = cols
+        self.shape = (a.shape[0], len(range(*cols.indices(a.shape[1]))))
+
+    def __getitem__(self, rows):
+        return self.a[rows, self.cols]
@@ -4,11 +4,22 @@ import os
 import sys
 import time
 import math
+import queue
+import logging
+import threading
 import tkinter as tk
+from collections import OrderedDict
 
 from tkinter import ttk
 from PIL import Image, ImageTk
 
+TILE_SIZE = 256  # side of tiles of the zoomed image in canvas pixels
+TILE_CACHE_SIZE = 128  # number of rendered tiles kept for panning back
+TILE_BORDER = 8  # pixels around a tile read by the resampling filter
+TILE_POLL_MS = 15  # period of taking tiles rendered in the background into the view
+
+logger = logging.getLogger(__name__)
+
 
 def handle_exception(exit_code=0):
     """ Use: @land.logger.handle_exception(0)
@@ -68,6 +79,7 @@ class CanvasImage:
         self.vbar.configure(command=self.__scroll_y)
         # Bind events to the Canvas
         self.canvas.bind('<Configure>', lambda event: self.__size_changed())  # canvas is resized
+        self.canvas.bind('<Destroy>', lambda event: self.destroy(), add='+')  # window is closed
         self.canvas.bind('<Button-1>', self.__left_mouse_button)  # remember canvas position
         self.canvas.bind('<ButtonPress-3>', self.__right_mouse_button_pressed)  # remember canvas position
         self.canvas.bind('<ButtonRelease-3>', self.__right_mouse_button_released)  # remember canvas position
@@ -80,21 +92,49 @@ class CanvasImage:
         self.canvas.bind('<Key>', lambda event: self.canvas.after_idle(self.__keystroke, event))
         self.container = None
         self.__original_image = None
-        self.__current_image = None
+        self.__pyramid = []  # original image and its power-of-two reductions, built lazily
+        self.__tiles = OrderedDict()  # (scale, tile x, tile y) -> rendered tile, least recently used first
+        self.__tile_items = {}  # (scale, tile x, tile y) -> canvas item and tile shown in the view
+        self.__pending = set()  # keys of tiles shown as placeholders until they are rendered in the background
+        self.__generation = 0  # incremented when tiles being rendered become stale
+        self.__requests = queue.Queue()  # (generation, key) of tiles to render, None stops the render thread
+        self.__rendered = queue.Queue()  # (generation, key, image) of rendered tiles
+        self.__render_lock = threading.Lock()  # held while the image and its reductions are read or changed
+        self.__render_thread = None
+        self.__poll_job = None
 
         self._click_callback = None
 
     def register_click_callback(self, click_callback):
         self._click_callback = click_callback
 
-    def patch_image(self, image):
-        self.__original_image = image
-        self.__current_image = image
+    def patch_image(self, image, box=None):
+        """Show image. The same image keeps its reductions and rendered tiles, if it was changed in place
+        inside box (x0, y0, x1, y1) this area of them is recomputed. See invalidate_image for other changes."""
+        with self.__render_lock:
+            if image is not self.__original_image:
+                self.__pyramid = [image]
+                self._drop_tiles()
+            elif box is not None:
+                self._patch_pyramid(box)
+                self._drop_tiles(box)
+            self.__original_image = image
+        self._show_image()
+
+    def invalidate_image(self):
+        """Render reductions and tiles of the shown image again after it was changed in place as a whole"""
+        with self.__render_lock:
+            if self.__original_image is None:
+                return
+            self.__pyramid = [self.__original_image]
+            self._drop_tiles()
         self._show_image()
 
     def reload_image(self, image, reset_canvas=True):
-        self.__original_image = image.copy()
-        self.__current_image = image.copy()
+        with self.__render_lock:
+            self.__original_image = image.copy()
+            self.__pyramid = [self.__original_image]
+            self._drop_tiles()
 
         if reset_canvas:
             self.imwidth, self.imheight = self.__original_image.size
@@ -143,37 +183,160 @@ class CanvasImage:
         x2 = min(box_canvas[2], box_image[2]) - box_image[0]
         y2 = min(box_canvas[3], box_image[3]) - box_image[1]
 
+        scale = self.current_scale
+        self.real_scale = (scale, scale)  # tiles are resampled to the exact scale of the container
+        visible = set()
         if int(x2 - x1) > 0 and int(y2 - y1) > 0:  # show image if it in the visible area
-            border_width = 2
-            sx1, sx2 = x1 / self.current_scale, x2 / self.current_scale
-            sy1, sy2 = y1 / self.current_scale, y2 / self.current_scale
-            crop_x, crop_y = max(0, math.floor(sx1 - border_width)), max(0, math.floor(sy1 - border_width))
-            crop_w, crop_h = math.ceil(sx2 - sx1 + 2 * border_width), math.ceil(sy2 - sy1 + 2 * border_width)
-            crop_w = min(crop_w, self.__original_image.width - crop_x)
-            crop_h = min(crop_h, self.__original_image.height - crop_y)
-
-            __current_image = self.__original_image.crop((crop_x, crop_y,
-                                                          crop_x + crop_w, crop_y + crop_h))
-            crop_zw = int(round(crop_w * self.current_scale))
-            crop_zh = int(round(crop_h * self.current_scale))
-            zoom_sx, zoom_sy = crop_zw / crop_w, crop_zh / crop_h
-            crop_zx, crop_zy = crop_x * zoom_sx, crop_y * zoom_sy
-            self.real_scale = (zoom_sx, zoom_sy)
-
-            interpolation = Image.NEAREST if self.current_scale > 2.0 else Image.ANTIALIAS
-            __current_image = __current_image.resize((crop_zw, crop_zh), interpolation)
-            zx1, zy1 = x1 - crop_zx, y1 - crop_zy
-            zx2 = min(zx1 + self.canvas.winfo_width(), __current_image.width)
-            zy2 = min(zy1 + self.canvas.winfo_height(), __current_image.height)
-
-            self.__current_image = __current_image.crop((zx1, zy1, zx2, zy2))
-
-            imagetk = ImageTk.PhotoImage(self.__current_image)
-            imageid = self.canvas.create_image(max(box_canvas[0], box_img_int[0]),
-                                               max(box_canvas[1], box_img_int[1]),
-                                               anchor='nw', image=imagetk)
-            self.canvas.lower(imageid)  # set image into background
-            self.canvas.imagetk = imagetk  # keep an extra reference to prevent garbage-collection
+            x2 = min(x2, round(self.__original_image.width * scale))
+            y2 = min(y2, round(self.__original_image.height * scale))
+            visible = {(scale, tx, ty) for tx in range(int(x1 // TILE_SIZE), math.ceil(x2 / TILE_SIZE))
+                       for ty in range(int(y1 // TILE_SIZE), math.ceil(y2 / TILE_SIZE))}
+        for key in set(self.__tile_items) - visible:  # tiles which left the view or of another zoom
+            self.canvas.delete(self.__tile_items.pop(key)[0])
+            self.__pending.discard(key)  # not rendered any more if it is still waiting
+        for key in visible - set(self.__tile_items):  # only tiles entering the view are rendered
+            tile = self.__tiles.get(key)
+            if tile is None:
+                tile = ImageTk.PhotoImage(self._render_placeholder(*key))
+                self._request_tile(key)
+            else:
+                self.__tiles.move_to_end(key)
+            item = self.canvas.create_image(box_image[0] + key[1] * TILE_SIZE, box_image[1] + key[2] * TILE_SIZE,
+                                            anchor='nw', image=tile)
+            self.canvas.lower(item)  # set image into background
+            self.__tile_items[key] = (item, tile)  # keep a reference to prevent garbage-collection
+
+    def _request_tile(self, key):
+        self.__pending.add(key)
+        self.__requests.put((self.__generation, key))
+        if self.__render_thread is None:
+            self.__render_thread = threading.Thread(target=self._render_tiles, daemon=True)
+            self.__render_thread.start()
+        if self.__poll_job is None:
+            self.__poll_job = self.canvas.after(TILE_POLL_MS, self._receive_tiles)
+
+    def _render_tiles(self):
+        """ Render requested tiles in the background, skipping those which are not waited for any more """
+        while True:
+            request = self.__requests.get()
+            if request is None:
+                return
+            generation, key = request
+            try:
+                with self.__render_lock:
+                    if generation != self.__generation or key not in self.__pending:
+                        continue
+                    image = self._render_tile(*key)  # PIL releases the GIL while resampling
+            except Exception:
+                logger.exception(f'Cannot render tile {key}')
+                image = None  # the placeholder stays in the view
+            self.__rendered.put((generation, key, image))
+
+    def _receive_tiles(self):
+        """ Replace placeholders by tiles rendered in the background, in the Tk thread """
+        self.__poll_job = None
+        if not self.canvas.winfo_exists():
+            return
+        while not self.__rendered.empty():
+            generation, key, image = self.__rendered.get()
+            if generation != self.__generation or key not in self.__pending:
+                continue
+            self.__pending.discard(key)
+            if image is None:
+                continue
+            tile = ImageTk.PhotoImage(image)
+            self.__tiles[key] = tile
+            while len(self.__tiles) > TILE_CACHE_SIZE:
+                self.__tiles.popitem(last=False)
+            item = self.__tile_items[key][0]
+            self.canvas.itemconfigure(item, image=tile)
+            self.__tile_items[key] = (item, tile)
+        if self.__pending:
+            self.__poll_job = self.canvas.after(TILE_POLL_MS, self._receive_tiles)
+
+    def destroy(self):
+        """ Stop the render thread and release the image, its reductions and tiles """
+        if self.__poll_job is not None:
+            try:
+                self.canvas.after_cancel(self.__poll_job)
+            except tk.TclError:
+                pass
+            self.__poll_job = None
+        if self.__render_thread is not None:
+            self.__requests.put(None)
+            self.__render_thread = None
+        with self.__render_lock:
+            self.__generation += 1
+            self.__pending.clear()
+            self.__tiles.clear()
+            self.__tile_items.clear()
+            self.__pyramid = []
+            self.__original_image = None
+
+    def _render_placeholder(self, scale, tx, ty):
+        """ Coarse tile sampled without filtering from a reduction which is already built """
+        level = max(0, math.floor(math.log2(1 / scale)))
+        image = self.__pyramid[min(level, len(self.__pyramid) - 1)]
+        f = image.width / self.__original_image.width
+        x0, y0, x1, y1 = self._tile_box(scale, tx, ty)
+        return image.resize((x1 - x0, y1 - y0), Image.NEAREST,
+                            box=(x0 * f / scale, y0 * f / scale, min(x1 * f / scale, image.width),
+                                 min(y1 * f / scale, image.height)))
+
+    def _tile_box(self, scale, tx, ty):
+        """ Canvas pixels (x0, y0, x1, y1) covered by tile (tx, ty) relative to the image corner """
+        x0, y0 = tx * TILE_SIZE, ty * TILE_SIZE
+        return (x0, y0, min(x0 + TILE_SIZE, max(x0 + 1, round(self.__original_image.width * scale))),
+                min(y0 + TILE_SIZE, max(y0 + 1, round(self.__original_image.height * scale))))
+
+    def _render_tile(self, scale, tx, ty):
+        """ Tile (tx, ty) of the image zoomed to scale, resampled from the smallest sufficient reduction """
+        image = self._get_pyramid_level(scale)
+        sx = scale * self.__original_image.width / image.width  # canvas pixels per pixel of the reduction
+        sy = scale * self.__original_image.height / image.height
+        x0, y0, x1, y1 = self._tile_box(scale, tx, ty)
+        crop = (max(0, math.floor(x0 / sx) - TILE_BORDER), max(0, math.floor(y0 / sy) - TILE_BORDER),
+                min(image.width, math.ceil(x1 / sx) + TILE_BORDER), min(image.height, math.ceil(y1 / sy) + TILE_BORDER))
+        box = (x0 / sx - crop[0], y0 / sy - crop[1],
+               min(x1 / sx, image.width) - crop[0], min(y1 / sy, image.height) - crop[1])
+        interpolation = Image.NEAREST if scale > 2.0 else Image.LANCZOS
+        return image.crop(crop).resize((x1 - x0, y1 - y0), interpolation, box=box)
+
+    def _drop_tiles(self, box=None):
+        """ Forget rendered tiles showing box (x0, y0, x1, y1) of the image, all tiles if box is None """
+        for key in [k for k in set(self.__tiles) | set(self.__tile_items) if box is None or self._tile_in(k, box)]:
+            self.__tiles.pop(key, None)
+            self.__pending.discard(key)
+            if key in self.__tile_items:
+                self.canvas.delete(self.__tile_items.pop(key)[0])
+        self.__generation += 1  # tiles being rendered may show the image before the change
+        for key in self.__pending:
+            self.__requests.put((self.__generation, key))
+
+    @staticmethod
+    def _tile_in(key, box):
+        scale, tx, ty = key
+        margin = (TILE_BORDER + 2) * max(scale, 1)  # pixels around box reached by reductions and resampling
+        return (box[0] * scale - margin < (tx + 1) * TILE_SIZE and tx * TILE_SIZE < box[2] * scale + margin and
+                box[1] * scale - margin < (ty + 1) * TILE_SIZE and ty * TILE_SIZE < box[3] * scale + margin)
+
+    def _get_pyramid_level(self, scale):
+        """ Smallest power-of-two reduction of the image which is still not smaller than scale """
+        level = max(0, math.floor(math.log2(1 / scale)))
+        while len(self.__pyramid) <= level and min(self.__pyramid[-1].size) > 1:
+            self.__pyramid.append(self.__pyramid[-1].reduce(2))  # next level is built on first use
+        return self.__pyramid[min(level, len(self.__pyramid) - 1)]
+
+    def _patch_pyramid(self, box):
+        """Recompute reductions inside box of the original image, which was changed in place."""
+        for level in range(1, len(self.__pyramid)):
+            previous = self.__pyramid[level - 1]
+            x0, y0 = box[0] // 2 * 2, box[1] // 2 * 2  # aligned to blocks averaged by reduce
+            x1, y1 = min(box[2] + box[2] % 2, previous.width), min(box[3] + box[3] % 2, previous.height)
+            if x0 >= x1 or y0 >= y1:
+                return
+            box = (x0 // 2, y0 // 2, (x1 + 1) // 2, (y1 + 1) // 2)
+            self.__pyramid[level].paste(previous.crop((x0, y0, x1, y1)).reduce(2), box[:2])
 
     def _get_click_coordinates(self, event):
         x = self.canvas.canvasx(event.x)  # get coordinates of the event on the canvas
@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+from utils import TMP_FOLDER
+
+DEFAULT_DISK_BYTES = int(os.environ.get('SOIL_REGION_DISK_CACHE_MB', 10240)) * 2 ** 20
+
+
+class SessionCache:
+    """ On-disk cache of a scene: arrays as memory-mapped .npy files and session state as json.
+        Entries are stored in a directory keyed by path, mtime and size of the scene files. """
+
+    def __init__(self, root=None, max_bytes=DEFAULT_DISK_BYTES):
+        self.root = root or os.environ.get('SOIL_REGION_CACHE_DIR') or os.path.join(TMP_FOLDER, 'soil_region_cache')
+        self.max_bytes = max_bytes
+        self.key = None
+
+    @staticmethod
+    def make_key(paths):
+        h = hashlib.sha1()
+        for p in sorted(paths):
+            st = os.stat(p)
+            h.update(f'{os.path.abspath(p)}|{st.st_mtime_ns}|{st.st_size}\n'.encode())
+        return h.hexdigest()[:20]
+
+    def open(self, paths):
+        """Switch to the cache of the scene made of files `paths`."""
+        self.key = self.make_key(paths)
+        try:
+            os.makedirs(os.path.join(self.root, self.key), exist_ok=True)
+            os.utime(os.path.join(self.root, self.key))  # mtime of a scene directory is its last use
+        except OSError:
+            self.key = None
+        self.evict()
+
+    def evict(self):
+        """Delete least recently opened scenes other than the current one while the cache exceeds max_bytes."""
+        try:
+            scenes = [e for e in os.scandir(self.root) if e.is_dir() and e.name != self.key]
+            scenes = sorted(((e.stat().st_mtime, e.path) for e in scenes), reverse=True)
+            sizes = {path: self._size(path) for _, path in scenes}
+        except OSError:
+            return
+        total = sum(sizes.values()) + (self._size(os.path.join(self.root, self.key)) if self.key else 0)
+        while scenes and total > self.max_bytes:
+            _, path = scenes.pop()
+            shutil.rmtree(path, ignore_errors=True)
+            total -= sizes[path]
+
+    @staticmethod
+    def _size(path):
+        try:
+            return sum(e.stat().st_size for e in os.scandir(path) if e.is_file())
+        except OSError:
+            return 0
+
+    def _path(self, name):
+        return os.path.join(self.root, self.key, name)
+
+    def load_array(self, name):
+        """Read-only memory map of a cached array or None."""
+        if self.key is None or not os.path.isfile(self._path(f'{name}.npy')):
+            return None
+        try:
+            return np.load(self._path(f'{name}.npy'), mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+
+    def save_array(self, name, array):
+        """Store array and return its read-only memory map (the array itself if it cannot be stored)."""
+        if self.key is None:
+            return array
+        fn = self._path(f'{name}.npy')
+        tmp = f'{fn}.{os.getpid()}.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                np.save(f, np.ascontiguousarray(array))
+            os.replace(tmp, fn)
+            return np.load(fn, mmap_mode='r')
+        except OSError:
+            return array
+        finally:
+            self._remove(tmp)
+
+    def load_json(self, name, default=None):
+        if self.key is None or not os.path.isfile(self._path(f'{name}.json')):
+            return default
+        try:
+            return json.load(open(self._path(f'{name}.json')))
+        except (OSError, ValueError):
+            return default
+
+    def save_json(self, name, obj):
+        if self.key is None:
+            return
+        fn = self._path(f'{name}.json')
+        tmp = f'{fn}.{os.getpid()}.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(obj, f)
+            os.replace(tmp, fn)
+        except (OSError, TypeError, ValueError):
+            pass
+        finally:
+            self._remove(tmp)
+
+    @staticmethod
+    def _remove(fn):
+        """Delete a leftover temporary file, if any."""
+        try:
+            os.remove(fn)
+        except OSError:  # already renamed into place
+            pass
@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+
+import batch_classify
+from utils import region_mask
+
+TRIANGLE = [[1, 1], [8, 1], [4, 6]]
+
+
+def test_region_mask_with_empty_polygons():
+    region = {'x_min': 0., 'x_max': 10., 'x_step': 1., 'y_min': 0., 'y_max': 10., 'y_step': 1.,
+              'channels': ['04', '05'], 'polygons': [[], [[]], [TRIANGLE, []]]}
+    mask = region_mask(region)
+    assert mask.array.shape == (10, 10)
+    assert set(np.unique(mask.array)) == {0, 2}
+
+
+@pytest.mark.parametrize('jobs', ['0', '-2'])
+def test_jobs_must_be_positive(jobs, capsys):
+    with pytest.raises(SystemExit) as e:
+        batch_classify.main(['region.json', 'scene_LC08_red_04.tif', '--jobs', jobs])
+    assert e.value.code == 2
+    assert '--jobs must be at least 1' in capsys.readouterr().err
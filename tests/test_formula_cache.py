@@ -0,0 +1,39 @@
+import json
+import os
+
+import numpy as np
+
+from map_app import MapImage
+from utils import SATELLITE_CHANNELS
+
+
+def write_formula(text, mtime_ns):
+    with open('formulas.json', 'w') as f:
+        json.dump({'formulas': {'30': text}}, f)
+    os.utime('formulas.json', ns=(mtime_ns, mtime_ns))
+
+
+def scene(tmp_path):
+    m = MapImage(np.zeros((3, 3), dtype=int), cache_dir=str(tmp_path / 'cache'))
+    m.chan_dict = SATELLITE_CHANNELS['LC08']
+    m.chan_dict_rev = {v: k for k, v in m.chan_dict.items()}
+    rng = np.random.default_rng(0)
+    m.bands = {b: rng.integers(1, 1000, (40, 30)).astype(np.uint16) for b in ['red', 'nir', 'blue']}
+    return m
+
+
+def test_formula_change_with_explicit_shape(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    m = scene(tmp_path)
+    red = m.bands['red'].astype(np.float32)
+    write_formula('red + 1', 10 ** 18)
+    for shape in [(40, 30), (20, 15)]:
+        assert np.array_equal(m.get_bands(['30'], shape=shape)[0], (red + 1)[::40 // shape[0], ::30 // shape[1]])
+    counts = m.bin_index(['30', '04'], (0, 2000), (0, 1000), (20, 10), shape=(20, 15)).histogram()[0]
+
+    write_formula('red + 1000', 2 * 10 ** 18)
+    for shape in [(40, 30), (20, 15)]:
+        assert np.array_equal(m.get_bands(['30'], shape=shape)[0], (red + 1000)[::40 // shape[0], ::30 // shape[1]])
+    changed = m.bin_index(['30', '04'], (0, 2000), (0, 1000), (20, 10), shape=(20, 15)).histogram()[0]
+    assert changed[:10].sum() < counts[:10].sum()
+    assert changed.sum() == counts.sum() == 20 * 15
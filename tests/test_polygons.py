@@ -0,0 +1,42 @@
+import numpy as np
+
+from session_cache import SessionCache
+from utils import Mask, complete_polygons, polygons_bbox, rasterize_polygons
+
+TRIANGLE = [[1, 1], [8, 1], [4, 6]]
+
+
+def test_rasterize_skips_incomplete_polygons():
+    out = rasterize_polygons([[], [[2, 2]], [[2, 2], [5, 5]], TRIANGLE], 1, np.zeros((10, 10), dtype=np.uint8))
+    assert np.array_equal(out, rasterize_polygons([TRIANGLE], 1, np.zeros((10, 10), dtype=np.uint8)))
+
+
+def test_polygons_bbox_of_incomplete_polygons():
+    assert polygons_bbox([[], [[2, 2], [3, 3]]]) is None
+    assert polygons_bbox([[], TRIANGLE]) == (1, 9, 1, 7)
+
+
+def test_restore_empty_polygons(tmp_path):
+    scene = tmp_path / 'scene.tif'
+    scene.write_bytes(b'scene')
+    cache = SessionCache(str(tmp_path / 'cache'))
+    cache.open([str(scene)])
+    cache.save_json('polygons', {'map': [[], [[]]], 'region': None})
+
+    state = cache.load_json('polygons')
+    assert state['map'] == [[], [[]]]
+    raster = np.zeros((10, 10), dtype=np.uint8)
+    for n, polygons in enumerate(state['map']):
+        rasterize_polygons(polygons, n, raster)
+    assert not raster.any()
+    assert [complete_polygons(p) for p in state['map']] == [[], []]
+
+
+
+def test_mask_keeps_labels_of_its_update():
+    raster = rasterize_polygons([TRIANGLE], 1, np.zeros((10, 10), dtype=np.uint8))
+    mask = Mask(0., 10., 1., 0., 10., 1., raster, ['04', '05'])
+    raster[:] = 1  # polygons edited after the map was updated
+    x = np.array([[0.5, 4.5]])
+    assert mask.get_value(x, x).tolist() == [[0, 1]]
+    assert not mask.array.all()
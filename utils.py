@@ -1,20 +1,19 @@
 import os
 import sys
+from functools import lru_cache
 
 import numpy as np
 from tkinter import ttk
-from PIL import Image
-import matplotlib.pyplot as plt
-from matplotlib.transforms import Bbox
+from PIL import Image, ImageDraw
 from tempfile import gettempdir
 
-from matplotlib.colors import LinearSegmentedColormap, hsv_to_rgb
-from screeninfo import get_monitors
-from skimage.draw import polygon
-
+from histogram import bin_dtype, bin_index
 from segcanvas.canvas import CanvasImage
 
 TMP_FOLDER = gettempdir()  # system temp directory
+HIST_SIZE = (380, 300)  # size of images of channel histograms
+HIST_COLOR = (31, 119, 180)
+PICK_RADIUS = 5  # distance in pixels within which a click picks a vertex or an edge center
 
 SATELLITE_CHANNELS = {
     'LT04': {
@@ -61,6 +60,8 @@ SATELLITE_CHANNELS = {
 
 
 class Mask:
+    chunk_rows = 2 ** 20  # pixels classified at once, rows of the chunk are computed from the width of the input
+
     def __init__(self, x_min, x_max, x_step, y_min, y_max, y_step, array, channels):
         self.x_min = x_min
         self.x_max = x_max
@@ -68,16 +69,156 @@ class Mask:
         self.y_min = y_min
         self.y_max = y_max
         self.y_step = y_step
-        self.array = array
         self.channels = channels
-
-    def get_value(self, x, y):
-        x_ = np.maximum(np.minimum(((x - self.x_min) // self.x_step).astype(int), self.array.shape[0] - 1), 0)
-        y_ = np.maximum(np.minimum(((y - self.y_min) // self.y_step).astype(int), self.array.shape[1] - 1), 0)
-        return self.array.flatten()[x_ * self.array.shape[1] + y_]
+        self.update_array(array)
+
+    def get_value(self, x, y, out=None):
+        """uint8 class of each pixel having values x and y of the mask channels, written into out if it is given."""
+        if out is None:
+            out = np.empty(x.shape, dtype=np.uint8)
+        n_x, n_y = self.array.shape
+        rows = max(1, self.chunk_rows // max(1, int(np.prod(x.shape[1:]))))
+        shape = (min(rows, len(x)),) + x.shape[1:]
+        x_buf = np.empty(shape, dtype=bin_dtype(x, self.x_min, self.x_step))
+        y_buf = np.empty(shape, dtype=bin_dtype(y, self.y_min, self.y_step))
+        x_idx, y_idx = np.empty(shape, dtype=np.intp), np.empty(shape, dtype=np.intp)
+        for r0 in range(0, len(x), rows):
+            r1 = min(r0 + rows, len(x))
+            xi, yi = x_idx[:r1 - r0], y_idx[:r1 - r0]
+            bin_index(x[r0:r1], self.x_min, self.x_step, n_x, xi, x_buf[:r1 - r0])
+            bin_index(y[r0:r1], self.y_min, self.y_step, n_y, yi, y_buf[:r1 - r0])
+            xi *= n_y
+            xi += yi
+            np.take(self._labels, xi, out=out[r0:r1])
+        return out
 
     def update_array(self, array):
-        self.array = array
+        self.array = np.array(array, dtype=np.uint8, order='C')  # a copy, rasters of polygons are redrawn in place
+        self._labels = self.array.ravel()
+
+
+def rasterize_polygons(polygons, value, out, offset=(0, 0)):
+    """Set pixels of out inside polygons (lists of [x, y] vertices) to value.
+    out may be a window of a raster starting at offset, only pixels of the window are visited."""
+    from skimage.draw import polygon  # scikit-image pulls in scipy, kept off the startup path
+
+    for p in complete_polygons(polygons):
+        p = np.array(p) - offset
+        rr, cc = polygon(p[:, 0], p[:, 1], out.shape)
+        out[rr, cc] = value
+    return out
+
+
+def complete_polygons(polygons):
+    """Polygons having at least 3 vertices, leaving out those being drawn or saved while empty."""
+    return [p for p in polygons if len(p) >= 3]
+
+
+def polygons_bbox(polygons):
+    """Bounding box (x0, x1, y0, y1) of the pixels polygons can cover, None if they have no vertices."""
+    vertices = [v for p in complete_polygons(polygons) for v in p]
+    if not vertices:
+        return None
+    x, y = np.array(vertices).T
+    return int(x.min()), int(x.max()) + 1, int(y.min()), int(y.max()) + 1
+
+
+def region_mask(region):
+    """Mask of all polygons of a region saved by HistogramWindow, later tabs are drawn over earlier ones."""
+    shape = (int(round((region['x_max'] - region['x_min']) / region['x_step'])),
+             int(round((region['y_max'] - region['y_min']) / region['y_step'])))
+    array = np.zeros(shape, dtype=np.uint8)
+    for n in range(1, len(region['polygons'])):
+        rasterize_polygons(region['polygons'][n], n, array)
+    return Mask(region['x_min'], region['x_max'], region['x_step'], region['y_min'], region['y_max'],
+                region['y_step'], array, region['channels'])
+
+
+def polygon_vertices(polygons):
+    """Vertices of all polygons as an array (n, 2), index of the polygon of each vertex and of the vertex
+    following it in its polygon."""
+    sizes = np.array([len(p) for p in polygons], dtype=np.intp)
+    starts = np.concatenate([[0], np.cumsum(sizes)])
+    polygon = np.repeat(np.arange(len(polygons)), sizes)
+    following = np.arange(1, starts[-1] + 1)
+    following[starts[1:][sizes > 0] - 1] = starts[:-1][sizes > 0]  # last vertex is followed by the first one
+    return np.array([v for p in polygons for v in p]).reshape(-1, 2), polygon, following
+
+
+class Movables:
+    """ Vertices and centers of edges of polygons of tab n, which can be picked by a click.
+        Points are ordered like the polygons (vertex i, then center of edge i, i + 1) and indexed by cells
+        of PICK_RADIUS sorted by cell, so that picking searches only the cells around the click. """
+
+    def __init__(self, polygons, n):
+        self.polygons = polygons
+        self.n = n
+        vertices, self.polygon, following = polygon_vertices(polygons)
+        self.starts = np.concatenate([[0], np.cumsum([len(p) for p in polygons], dtype=np.intp)])
+        self.vertex = np.arange(len(vertices)) - self.starts[self.polygon]  # index of the vertex in its polygon
+        self.points = np.empty((2 * len(vertices), 2), dtype=vertices.dtype)
+        self.points[0::2] = vertices
+        self.points[1::2] = (vertices + vertices[following]) // 2
+
+        self.cells = self._cell(self.points)
+        self.order = np.argsort(self.cells)
+        self.sorted_cells = self.cells[self.order]
+
+    @staticmethod
+    def _cell(points):
+        cells = np.floor_divide(points, PICK_RADIUS).astype(np.int64)
+        return cells[..., 0] * 2 ** 32 + cells[..., 1]
+
+    def move_vertex(self, k, i):
+        """Take into account a move of vertex i of polygon k. False if vertices of the polygon were added or
+        removed since the points were built, then they must be rebuilt."""
+        p = self.polygons[k]
+        if k >= len(self.starts) - 1 or len(p) != self.starts[k + 1] - self.starts[k]:
+            return False
+        v, previous = self.starts[k] + i, self.starts[k] + (i - 1) % len(p)
+        self.points[2 * v] = p[i]
+        self.points[2 * v + 1] = (np.array(p[i]) + p[(i + 1) % len(p)]) // 2
+        self.points[2 * previous + 1] = (np.array(p[(i - 1) % len(p)]) + p[i]) // 2
+        for j in {2 * v, 2 * v + 1, 2 * previous + 1}:
+            self._reindex(j)
+        return True
+
+    def _reindex(self, j):
+        cell = self._cell(self.points[j])
+        if cell == self.cells[j]:
+            return
+        lo, hi = np.searchsorted(self.sorted_cells, self.cells[j], 'left'), \
+            np.searchsorted(self.sorted_cells, self.cells[j], 'right')
+        position = lo + int(np.flatnonzero(self.order[lo:hi] == j)[0])
+        self.order = np.delete(self.order, position)
+        self.sorted_cells = np.delete(self.sorted_cells, position)
+        position = np.searchsorted(self.sorted_cells, cell)
+        self.order = np.insert(self.order, position, j)
+        self.sorted_cells = np.insert(self.sorted_cells, position, cell)
+        self.cells[j] = cell
+
+    def nearest(self, x, y):
+        """[x, y, n, k, i, 'vertex' or 'edge'] of the point nearest to (x, y) within PICK_RADIUS, first on a tie,
+        None if there is no such point."""
+        center = self._cell(np.array([x, y]))
+        candidates = []
+        for dx in (-2 ** 32, 0, 2 ** 32):  # neighbouring columns of cells, each a contiguous range of cells
+            lo = np.searchsorted(self.sorted_cells, center + dx - 1, side='left')
+            hi = np.searchsorted(self.sorted_cells, center + dx + 1, side='right')
+            candidates.append(self.order[lo:hi])
+        candidates = np.concatenate(candidates)
+        if len(candidates) == 0:
+            return None
+        distances = ((self.points[candidates] - (x, y)) ** 2).sum(axis=1)
+        best = np.lexsort((candidates, distances))[0]
+        if distances[best] > PICK_RADIUS ** 2:
+            return None
+        j = candidates[best]
+        return [*self.points[j].tolist(), self.n, int(self.polygon[j // 2]), int(self.vertex[j // 2]),
+                'vertex' if j % 2 == 0 else 'edge']
+
+    def __len__(self):
+        return len(self.points)
 
 
 def get_color(t, colors):
@@ -107,6 +248,29 @@ def string_to_value(s, dtype='int_to_str', logger=None):
         return None
 
 
+def hue_palette(n=256):
+    """uint8 colors (n, 3) going from black through hues 0.888 down to 0.021 of full saturation and value,
+    interpolated and converted to bytes like matplotlib does for a colormap made by LinearSegmentedColormap."""
+    hue = np.arange(888, 20, -1) / 1000
+    sector = (hue * 6.0).astype(int)
+    f = hue * 6.0 - sector
+    q, t, zero, one = 1.0 - f, 1.0 - (1.0 - f), np.zeros_like(f), np.ones_like(f)
+    rgb = np.choose(sector[:, None] % 6, [np.stack(c, axis=-1) for c in [(one, t, zero), (q, one, zero),
+                                                                         (zero, one, t), (zero, q, one),
+                                                                         (t, zero, one), (one, zero, q)]])
+    stops = np.concatenate([np.zeros((1, 3)), rgb])
+
+    x = np.linspace(0, 1, len(stops)) * (n - 1)
+    xind = (n - 1) * np.linspace(0, 1, n)
+    ind = np.searchsorted(x, xind)[1:-1]
+    distance = ((xind[1:-1] - x[ind - 1]) / (x[ind] - x[ind - 1]))[:, None]
+    lut = np.concatenate([stops[:1], distance * (stops[ind] - stops[ind - 1]) + stops[ind - 1], stops[-1:]])
+    return (np.clip(lut, 0.0, 1.0) * 255).astype(np.uint8)
+
+
+HIST2D_PALETTE = hue_palette()
+
+
 def plot_hist2d(hist):
     """2-dimensional array to Image"""
     array = hist.copy()
@@ -119,26 +283,34 @@ def plot_hist2d(hist):
     h, _ = np.histogram(array.flatten(), array.max() + 1)
     cdf = (h ** .5).cumsum()
 
-    cmap = LinearSegmentedColormap.from_list('my_cmap',
-                                             [hsv_to_rgb([0, 0, 0])] +
-                                             [hsv_to_rgb([i / 1000, 1, 1]) for i in range(888, 20, -1)])
-    fn = os.path.join(TMP_FOLDER, 'hist2d.png')
-    plt.imsave(fn, cdf[array].transpose()[::-1, :], cmap=cmap)
-    plt.close('all')
-    return Image.open(fn).convert('RGB')
+    # colors of every level of the equalized counts, normalized to [0, 1] over the levels present
+    low, high = cdf[array.min()], cdf[array.max()]
+    norm = (cdf - low) / (high - low) if high > low else np.zeros_like(cdf)
+    index = norm * len(HIST2D_PALETTE)
+    index[index == len(HIST2D_PALETTE)] = len(HIST2D_PALETTE) - 1
+    colors = HIST2D_PALETTE[index.astype(int)]
+    return Image.fromarray(colors[array.transpose()[::-1, :]], mode='RGB')
+
 
+def plot_hist(counts, low, high):
+    """Bar chart Image of counts of equal bins over [low, high]"""
+    width, height = HIST_SIZE
+    left, right, top, bottom = 10, 10, 16, 16
+    plot_width, plot_height = width - left - right, height - top - bottom
 
-def plot_hist(x):
-    """1-dimensional array to histogram Image"""
-    q = x.flatten().copy()
-    q = q[~np.isnan(q)]
-    dpi = 100
-    plt.figure(figsize=(380 / dpi, 300 / dpi), dpi=dpi)
-    plt.hist(q, bins=256)
-    fn = os.path.join(TMP_FOLDER, 'hist.png')
-    plt.savefig(fn, bbox_inches=Bbox([[0, 0], [380 / dpi, 300 / dpi]]), dpi=dpi)
-    plt.close('all')
-    return Image.open(fn).convert('RGB')
+    array = np.full((height, width, 3), 255, dtype=np.uint8)
+    bars = counts[np.arange(plot_width) * len(counts) // plot_width]  # bin shown in every column
+    bars = np.round(bars / max(counts.max(), 1) * plot_height).astype(int)
+    plot = array[top:top + plot_height, left:left + plot_width]
+    plot[np.arange(plot_height)[:, None] >= plot_height - bars] = HIST_COLOR
+    array[top + plot_height, left:left + plot_width] = 0
+
+    image = Image.fromarray(array, mode='RGB')
+    draw = ImageDraw.Draw(image)
+    draw.text((left, 2), str(int(counts.max())), fill=(0, 0, 0))
+    draw.text((left, height - bottom + 3), f'{low:.6g}', fill=(0, 0, 0))
+    draw.text((width - right - draw.textlength(f'{high:.6g}'), height - bottom + 3), f'{high:.6g}', fill=(0, 0, 0))
+    return image
 
 
 class TabPolygonImage(CanvasImage):
@@ -149,27 +321,45 @@ class TabPolygonImage(CanvasImage):
         self.canvas.bind('<B1-Motion>', self._left_mouse_moving)  # move vertex or subdivide edge
         self.canvas.bind('<ButtonRelease-1>', self._left_mouse_button_released)  # move vertex or subdivide edge
         self.base_image = base_image
-        self.base_array = np.array(self.base_image).transpose([1, 0, 2])
-        self.shape = self.base_array.shape[:2]
+        self.crafted_image = None
+        self._crafted_tab = None  # tab whose polygons are drawn on crafted_image, None if it must be rebuilt
+        self.shape = (base_image.width, base_image.height)
         self.root = root
         self.colors = colors
 
         self.tab = 0
         self.mode = 'DEFAULT'
         self.n_tabs = n_tabs
-        self.rasters = [np.zeros(self.shape, dtype=int) for _ in range(self.n_tabs)]
+        self.rasters = [np.zeros(self.shape, dtype=np.uint8) for _ in range(self.n_tabs)]
         self.polygons = [[] for _ in range(self.n_tabs)]  # list of polygons for each tab
-        self.movables = [[] for _ in range(self.n_tabs)]  # vertices and centers of edges for polygons of a tab
+        self.movables = [Movables([], n) for n in range(self.n_tabs)]  # vertices and centers of edges of a tab
         self._last_lb_click_event = None
         self.__double_click_flag = False
+        self._edit_callback = None
+        self._overlay_topology = None  # tab and numbers of vertices of polygons drawn by canvas items
+        self._overlay_items = []
+        self._overlay_coords = None  # view and coordinates the items were last moved to
         self._create_crafted_image(0)
 
+    def register_edit_callback(self, edit_callback):
+        self._edit_callback = edit_callback
+
+    def _polygons_edited(self):
+        if self._edit_callback is not None:
+            self._edit_callback()
+
     def reload_image(self, image, reset_canvas=True):
         super().reload_image(image, reset_canvas)
         self.base_image = image
-        self.base_array = np.array(self.base_image).transpose([1, 0, 2])
-        self.shape = self.base_array.shape[:2]
-        self.rasters = [np.zeros(self.shape, dtype=int) for _ in range(self.n_tabs)]
+        self._crafted_tab = None
+        self.shape = (image.width, image.height)
+        self.rasters = [np.zeros(self.shape, dtype=np.uint8) for _ in range(self.n_tabs)]
+
+    def refresh_base_image(self):
+        """Take into account a change of the base image made in place."""
+        self._crafted_tab = None
+        self._create_crafted_image(self.tab)
+        self.invalidate_image()
 
     def to_tab(self, n):
         self.tab = n
@@ -182,37 +372,67 @@ class TabPolygonImage(CanvasImage):
         else:
             self.patch_image(self.base_image)
 
-    def update_raster(self, n):
-        self.rasters[n] = np.zeros(self.shape, dtype=int)
+    def update_raster(self, n, bbox=None):
+        """Rasterize polygons of tab n. If bbox (x0, x1, y0, y1) is given, only pixels inside it are redrawn,
+        for tab n and for the composite of tab 0."""
+        if bbox is None:
+            self.rasters[n][:] = 0
+            if n > 0:
+                rasterize_polygons(self.polygons[n], n, self.rasters[n])
+            if n == 0:
+                for m in range(1, self.n_tabs):
+                    self.rasters[0][self.rasters[m] > 0] = m
+            return
+
+        x0, x1, y0, y1 = max(bbox[0], 0), min(bbox[1], self.shape[0]), max(bbox[2], 0), min(bbox[3], self.shape[1])
+        if x0 >= x1 or y0 >= y1:
+            return
+        window = (slice(x0, x1), slice(y0, y1))
         if n > 0:
-            for p in self.polygons[n]:
-                p = np.array(p)
-                rr, cc = polygon(p[:, 0], p[:, 1], self.shape)
-                self.rasters[n][rr, cc] = n
-        if n == 0:
-            for m in range(1, self.n_tabs):
-                self.rasters[0][self.rasters[m] > 0] = m
+            self.rasters[n][window] = 0
+            rasterize_polygons(self.polygons[n], n, self.rasters[n][window], (x0, y0))
+        composite = self.rasters[0][window]
+        composite[:] = 0
+        for m in range(1, self.n_tabs):
+            composite[self.rasters[m][window] > 0] = m
 
     def update_movables(self, n):
         if n > 0:
-            self.movables[n] = []
-            for k in range(len(self.polygons[n])):
-                p = self.polygons[n][k]
-                for i in range(len(p)):
-                    x, y = tuple(p[i])
-                    x_, y_ = tuple(p[(i + 1) % len(p)])
-                    self.movables[n] += [[x, y, n, k, i, 'vertex'],
-                                         [(x + x_) // 2, (y + y_) // 2, n, k, i, 'edge']]
-
-    def _create_crafted_image(self, n):
-        raster = self.rasters[n][:, ::-1]
-        crafted_image_array = get_color(raster, self.colors)
-        if n == 0:
-            crafted_image_array = crafted_image_array * 0.5 + self.base_array * 0.5
+            self.movables[n] = Movables(self.polygons[n], n)
+
+    def _create_crafted_image(self, n, bbox=None):
+        """Draw polygons of tab n over the base image. If bbox (x0, x1, y0, y1) is given and crafted_image
+        already shows tab n, only pixels inside it are recomposited in place. Returns the changed image box."""
+        if bbox is None or self._crafted_tab != n:
+            bbox = (0, self.shape[0], 0, self.shape[1])
+            self.crafted_image = None
+        x0, x1, y0, y1 = max(bbox[0], 0), min(bbox[1], self.shape[0]), max(bbox[2], 0), min(bbox[3], self.shape[1])
+        if x0 >= x1 or y0 >= y1:
+            return None
+        box = (x0, self.shape[1] - y1, x1, self.shape[1] - y0)  # image rows go down from the top
+        labels = self.rasters[n][x0:x1, y0:y1].T[::-1]
+        region = Image.fromarray(self._crafted_region(n, labels, np.asarray(self.base_image.crop(box))), mode='RGB')
+        if self.crafted_image is None:
+            self.crafted_image = region
         else:
-            mask = np.array([raster == 0] * 3).transpose([1, 2, 0])
-            crafted_image_array = crafted_image_array * (1 - mask) + self.base_array * mask
-        self.crafted_image = Image.fromarray(crafted_image_array.astype('uint8').transpose([1, 0, 2]))
+            self.crafted_image.paste(region, box[:2])
+        self._crafted_tab = n
+        return box
+
+    def _crafted_region(self, n, labels, base):
+        """uint8 pixels (rows, cols, 3) of tab n with labels over the base pixels."""
+        colors = np.take(self.colors.astype(np.uint8), labels, axis=0)
+        if n == 0:
+            return ((colors.astype(np.uint16) + base) >> 1).astype(np.uint8)
+        return np.where((labels == 0)[..., None], base, colors)
+
+    def _redraw_edited(self, bbox):
+        """Show changes of polygons of the current tab inside bbox."""
+        box = None
+        if bbox is not None:
+            self.update_raster(self.tab, bbox)
+            box = self._create_crafted_image(self.tab, bbox)
+        self.patch_image(self.crafted_image, box)
 
     def mode_add_polygon(self, _ev):
         if self.tab > 0:
@@ -227,12 +447,11 @@ class TabPolygonImage(CanvasImage):
     def mode_default(self, _ev):
         self.mode = 'DEFAULT'
         if len(self.polygons[self.tab]) > 0 and len(self.polygons[self.tab][-1]) < 3:
+            bbox = polygons_bbox(self.polygons[self.tab][-1:])
             self.polygons[self.tab].pop(-1)
             self.update_movables(self.tab)
-            self.update_raster(self.tab)
-            self._create_crafted_image(self.tab)
-
-            self.patch_image(self.crafted_image)
+            self._redraw_edited(bbox)
+            self._polygons_edited()
 
     def _left_mouse_button_released(self, event):
         if self.__double_click_flag:
@@ -249,23 +468,28 @@ class TabPolygonImage(CanvasImage):
             return
         ev = self._last_lb_click_event
 
+        edited = None  # polygon changed by the move and a copy of it before the change
         if self.mode == 'DEFAULT':
             if coords is not None and self.tab is not None and self.tab > 0 and ev is not None:
                 _coords_old = [ev[0], ev[1]]
                 n, k, i, type_ = tuple(ev[2:])
+                edited = [self.polygons[n][k], [list(v) for v in self.polygons[n][k]]]
                 if type_ == 'vertex':
                     self.polygons[n][k][i] = [coords[0], coords[1]]
+                    if not self.movables[n].move_vertex(k, i):
+                        self.update_movables(n)
                 if type_ == 'edge':
                     self.polygons[n][k].insert(i + 1, [coords[0], coords[1]])
                     self._last_lb_click_event = [coords[0], coords[1], n, k, i + 1, 'vertex']
+                    self.update_movables(self.tab)
 
         elif self.mode == 'ADD':
+            edited = [self.polygons[self.tab][-1], [list(v) for v in self.polygons[self.tab][-1]]]
             self.polygons[self.tab][-1][-1] = [coords[0], coords[1]]
+            self.update_movables(self.tab)
 
-        self.update_movables(self.tab)
-        self.update_raster(self.tab)
-        self._create_crafted_image(self.tab)
-        self.patch_image(self.crafted_image)
+        self._redraw_edited(polygons_bbox(edited) if edited is not None else None)
+        self._polygons_edited()
 
     def _left_mouse_button_pressed(self, event):
         coords = self.get_click_coordinates(event)
@@ -278,6 +502,7 @@ class TabPolygonImage(CanvasImage):
                                                                [coords[0], coords[1]])
         elif self.tab > 0 and self.mode == 'ADD':
             self.polygons[self.tab][-1].append([coords[0], coords[1]])
+            self._polygons_edited()
 
         self._show_image()
 
@@ -286,10 +511,12 @@ class TabPolygonImage(CanvasImage):
 
         coords = self.get_click_coordinates(event)
 
+        bbox = None
         if coords is not None and self.tab is not None and self.tab > 0:
             nearest = self._find_nearest(self.tab, coords)
             if nearest is not None:
                 n, k, i, type_ = tuple(nearest[2:])
+                bbox = polygons_bbox([self.polygons[n][k]])
                 if type_ == 'vertex':
                     self.polygons[n][k].pop(i)
                     if len(self.polygons[n][k]) < 3:
@@ -298,19 +525,11 @@ class TabPolygonImage(CanvasImage):
                     self.polygons[n].pop(k)
 
         self.update_movables(self.tab)
-        self.update_raster(self.tab)
-        self._create_crafted_image(self.tab)
-        self.patch_image(self.crafted_image)
+        self._redraw_edited(bbox)
+        self._polygons_edited()
 
     def _find_nearest(self, n, coords):
-        if len(self.movables[n]) == 0:
-            return None
-        i = np.argmin([(p[0] - coords[0]) ** 2 + (p[1] - coords[1]) ** 2 for p in self.movables[n]])
-        i = int(i)
-        p = self.movables[n][i]
-        if (p[0] - coords[0]) ** 2 + (p[1] - coords[1]) ** 2 > 5 ** 2:
-            return None
-        return self.movables[n][i]
+        return self.movables[n].nearest(*coords)
 
     def get_click_coordinates(self, event):
         res = super()._get_click_coordinates(event)
@@ -332,31 +551,47 @@ class TabPolygonImage(CanvasImage):
 
     def _show_image(self):
         super()._show_image()
-        self.canvas.delete('polygons')
-
-        for p in self.polygons[self.tab]:
-            for i in range(len(p)):
-                x, y = self._polygon_coords_to_canvas_coords(*p[i])
-
-                x_, y_ = self._polygon_coords_to_canvas_coords(*p[(i + 1) % len(p)])
-                self.canvas.create_line(x, y, x_, y_, fill="#FADADD", width=3, tags='polygons')
-                self.canvas.create_oval((x + x_) // 2 - 3, (y + y_) // 2 - 3, (x + x_) // 2 + 3, (y + y_) // 2 + 3,
-                                        outline="#EFDECD", width=3, tags='polygons')
-
-        for p in self.polygons[self.tab]:
-            for i in range(len(p)):
-                x, y = self._polygon_coords_to_canvas_coords(*p[i])
-                self.canvas.create_oval(x - 5, y - 5, x + 5, y + 5, outline="#EFDECD", width=3, tags='polygons')
-
-    def patch_image(self, image):
-        super().patch_image(image)
+        self._show_polygons()
+
+    def _show_polygons(self):
+        """Draw polygons of the current tab. Canvas items are created only when vertices are added or removed,
+        otherwise the items whose position changed are moved."""
+        polygons = self.polygons[self.tab]
+        topology = (self.tab, [len(p) for p in polygons])
+        if topology != self._overlay_topology:
+            self.canvas.delete('polygons')
+            n = sum(topology[1])
+            edges = [(self.canvas.create_line(0, 0, 0, 0, fill="#FADADD", width=3, tags='polygons'),
+                      self.canvas.create_oval(0, 0, 0, 0, outline="#EFDECD", width=3, tags='polygons'))
+                     for _ in range(n)]
+            vertices = [self.canvas.create_oval(0, 0, 0, 0, outline="#EFDECD", width=3, tags='polygons')
+                        for _ in range(n)]  # created last to be drawn over all edges
+            self._overlay_items = [item for edge, vertex in zip(edges, vertices) for item in (*edge, vertex)]
+            self._overlay_topology = topology
+            self._overlay_coords = None
+
+        vertices, _, following = polygon_vertices(polygons)
+        x, y = self._polygon_coords_to_canvas_coords(vertices[:, 0].astype(float), vertices[:, 1].astype(float))
+        x_, y_ = x[following], y[following]
+        cx, cy = (x + x_) // 2, (y + y_) // 2
+        coords = np.stack([np.stack([x, y, x_, y_], axis=-1),
+                           np.stack([cx - 3, cy - 3, cx + 3, cy + 3], axis=-1),
+                           np.stack([x - 5, y - 5, x + 5, y + 5], axis=-1)], axis=1).reshape(-1, 4).tolist()
+
+        view = (self.canvas.coords(self.container), self.real_scale)  # items are scaled with the canvas on zoom
+        previous = self._overlay_coords
+        if previous is None or previous[0] != view:
+            previous = (view, [None] * len(coords))
+        for item, c, p in zip(self._overlay_items, coords, previous[1]):
+            if c != p:
+                self.canvas.coords(item, *c)
+        self._overlay_coords = (view, coords)
+
+    def patch_image(self, image, box=None):
+        super().patch_image(image, box)
         self._show_image()
 
 
-def copy_list(arg):
-    return [a.copy() for a in arg]
-
-
 class Keycode2Char:
     linux_table = {39: 's', 32: 'o', 36: 'enter', 19: '0'}
     linux_table.update({9 + n: str(n) for n in range(1, 10)})
@@ -388,14 +623,17 @@ def load_proj():
 keycode2char = Keycode2Char()
 
 
-def _calc_geom():
-    monitors = get_monitors()
-    i = int(np.argmax([m.height * m.width for m in monitors]))
-    m = monitors[i]
-    h, w, x, y = m.height, m.width, m.x, m.y
+@lru_cache(maxsize=None)
+def window_geometry():
+    """(width, height, x, y) of the map and the histogram windows on the largest monitor, probed on first use."""
+    from screeninfo import get_monitors, ScreenInfoError
+
+    try:
+        monitors = get_monitors()
+        m = monitors[int(np.argmax([m.height * m.width for m in monitors]))]
+        h, w, x, y = m.height, m.width, m.x, m.y
+    except ScreenInfoError:  # no display, e.g. batch classification on a server
+        h, w, x, y = 1080, 1920, 0, 0
     g_map = tuple(map(int, (w * 0.55, h * 0.7, y + w * .02, x + h * .05)))  # w, h, y, x
     g_hist = tuple(map(int, (w * 0.4, w * 0.4, g_map[2] + g_map[0] + w * .02, g_map[3])))
     return g_map, g_hist
-
-
-geometry_map, geometry_histogram = _calc_geom()